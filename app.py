@@ -1,16 +1,49 @@
 # app.py
 
-from flask import Flask, request, render_template_string, send_file, jsonify
-from document_agent import DocumentAgent
+from flask import Flask, request, render_template_string, send_file, jsonify, Response, stream_with_context, send_from_directory, url_for
 from email_service import EmailService 
+from work_queue import WorkQueue
+from profiling import profiler, ProfilingMiddleware
+from pdf_pool import PDFRenderPool
+from pipeline_engine import build_report_pipeline
+from memory_guard import memory_guard, MemoryBudgetExceeded, RecyclingMiddleware
+from stream_server import StreamServer, sse_event, STREAM_PORT
+import argparse
 import os
 import secrets 
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import RequestEntityTooLarge
 
 app = Flask(__name__)
+# Captures torch/cProfile traces only while armed through /admin/profile or --profile-* flags
+app.wsgi_app = ProfilingMiddleware(app.wsgi_app, profiler)
+# Drains and restarts the process after RECYCLE_AFTER_REQUESTS analyses or past RECYCLE_RSS_MB (see memory_guard.py)
+app.wsgi_app = RecyclingMiddleware(app.wsgi_app, memory_guard)
+
+# Token for /admin endpoints; they are disabled entirely when it isn't set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Start the PDF render workers before torch is even imported, so the forked processes stay small and inherit
+# no torch state
+pdf_pool = PDFRenderPool()
+pdf_pool.warm()
+
+from document_agent import DocumentAgent
 
 # Initialize your document analysis agent
 # This will trigger model loading at app startup
 agent = DocumentAgent() 
+# Loading the models ran torch ops, so the render pool must not fork replacement workers from here on. If a
+# worker dies it renders in-process and the process recycles, starting a fresh pool before the models load.
+pdf_pool.fork_safe = False
+pdf_pool.on_degraded = memory_guard.begin_drain
 
 # Initialize your email service
 email_service = EmailService() 
@@ -19,6 +52,32 @@ email_service = EmailService()
 REPORTS_FOLDER = "analysis_reports"
 os.makedirs(REPORTS_FOLDER, exist_ok=True) # Ensure this directory exists
 
+# Durable queue consumed by worker.py processes (see work_queue.py)
+work_queue = WorkQueue()
+
+# Limits for the JSON API
+API_MAX_DOCUMENTS = int(os.getenv("API_MAX_DOCUMENTS", 64)) # Max documents accepted per /api/analyze call
+API_BATCH_SIZE = int(os.getenv("API_BATCH_SIZE", 8)) # Documents per forward pass inside the pipelines
+API_GZIP_MIN_BYTES = int(os.getenv("API_GZIP_MIN_BYTES", 1024)) # Smaller responses are not worth compressing
+API_MAX_BODY_BYTES = int(os.getenv("API_MAX_BODY_BYTES", 16 * 1024 * 1024)) # Max request body, as sent and after gzip decompression
+app.config["MAX_CONTENT_LENGTH"] = API_MAX_BODY_BYTES
+API_RESULT_CACHE_SIZE = int(os.getenv("API_RESULT_CACHE_SIZE", 256)) # /api/analyze results kept for GET revalidation
+
+# Content-addressed /api/analyze results (documents digest -> response body), least recently used first
+api_results = OrderedDict()
+api_results_lock = threading.Lock()
+
+# Staged decode -> classify -> summarize -> render -> deliver pipeline used by /api/reports
+report_pipeline = build_report_pipeline(agent, email_service, pdf_pool=pdf_pool, output_dir=REPORTS_FOLDER).start()
+
+# Shared, bounded pool running T5 generation for /api/stream; streams wait on token queues, not on their own threads
+STREAM_GENERATION_WORKERS = int(os.getenv("STREAM_GENERATION_WORKERS", 2))
+generation_executor = ThreadPoolExecutor(max_workers=STREAM_GENERATION_WORKERS, thread_name_prefix="summary-stream")
+
+# os.execv skips atexit handlers, so persist state and stop child processes explicitly before recycling
+memory_guard.on_recycle(agent.save_near_duplicate_index)
+memory_guard.on_recycle(lambda: pdf_pool.shutdown(wait=False))
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -105,7 +164,7 @@ def index():
         if file:
             try:
                 text = file.read().decode("utf-8")
-                pdf_report_path = agent.generate_report(text, output_dir=REPORTS_FOLDER)
+                pdf_report_path = agent.generate_report(text, output_dir=REPORTS_FOLDER, pdf_pool=pdf_pool)
                 
                 email_message = "Report generated successfully. "
                 message_type = "success"
@@ -119,12 +178,13 @@ def index():
                         "Your AI Analysis Service"
                     )
                     try:
-                        email_service.send_email(
-                            to_email=to_email,
-                            subject=email_subject,
-                            body=email_body,
-                            attachment_path=pdf_report_path
-                        )
+                        with profiler.section("send_email"):
+                            email_service.send_email(
+                                to_email=to_email,
+                                subject=email_subject,
+                                body=email_body,
+                                attachment_path=pdf_report_path
+                            )
                         email_message += f"Email sent to {to_email}."
                         message_type = "success"
                     except ValueError as ve:
@@ -154,7 +214,293 @@ def index():
     
     return render_template_string(HTML_TEMPLATE, message=None)
 
+def _api_error(message: str, status: int):
+    return jsonify({"error": message}), status
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    if request.path.startswith("/api/"):
+        return _api_error(e.description or "Request body too large.", 413)
+    return e
+
+def _read_api_payload() -> dict:
+    # MAX_CONTENT_LENGTH rejects oversized bodies with 413
+    return _decode_api_body(request.get_data(), request.headers.get("Content-Encoding", ""))
+
+def _decode_api_body(raw_body: bytes, content_encoding: str) -> dict:
+    if content_encoding.lower() == "gzip":
+        # Read at most one byte past the limit so a small gzip bomb can't expand without bound
+        with gzip.GzipFile(fileobj=io.BytesIO(raw_body)) as decompressed:
+            raw_body = decompressed.read(API_MAX_BODY_BYTES + 1)
+        if len(raw_body) > API_MAX_BODY_BYTES:
+            raise RequestEntityTooLarge(f"Decompressed request body exceeds {API_MAX_BODY_BYTES} bytes.")
+    return json.loads(raw_body)
+
+def _extract_documents(payload) -> list:
+    # Accepts {"text": "..."} for a single document or {"documents": ["...", {"text": "..."}]} for a batch
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object.")
+    if "documents" in payload:
+        documents = payload["documents"]
+        if not isinstance(documents, list):
+            raise ValueError("'documents' must be a list.")
+    elif "text" in payload:
+        documents = [payload["text"]]
+    else:
+        raise ValueError("Request body must contain 'text' or 'documents'.")
+
+    texts = []
+    for document in documents:
+        if isinstance(document, dict):
+            document = document.get("text")
+        if not isinstance(document, str) or not document.strip():
+            raise ValueError("Every document must be a non-empty string or an object with a 'text' field.")
+        texts.append(document)
+    return texts
+
+def _documents_digest(texts: list) -> str:
+    # Identifies a batch of documents (and the models analysing them), so it can name the batch's result
+    digest = hashlib.sha256(os.getenv("MODEL_BASE_DIR", "/app/models").encode("utf-8"))
+    for text in texts:
+        encoded = text.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+def _json_result_response(body: bytes, status: int = 200) -> Response:
+    response = Response(body, status=status, mimetype="application/json")
+    # Weak: the same result is served both gzip-compressed and uncompressed
+    response.set_etag(hashlib.sha256(body).hexdigest(), weak=True)
+    response.headers["Vary"] = "Accept-Encoding"
+    if len(body) >= API_GZIP_MIN_BYTES and request.accept_encodings.quality("gzip") > 0:
+        response.set_data(gzip.compress(body))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+@app.route("/api/analyze", methods=["POST"])
+def api_analyze():
+    # Runs the analysis and stores the response at /api/analyze/<digest> (returned as Content-Location and
+    # result_url). Clients revalidate with a conditional GET there; POST itself is never answered with 304.
+    try:
+        texts = _extract_documents(_read_api_payload())
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        return _api_error(f"Malformed request body: {e}", 400)
+    except ValueError as ve:
+        return _api_error(str(ve), 400)
+
+    if len(texts) > API_MAX_DOCUMENTS:
+        return _api_error(f"Too many documents: {len(texts)} (limit is {API_MAX_DOCUMENTS}).", 413)
+
+    try:
+        start = time.perf_counter()
+        results = agent.analyze_documents(texts, batch_size=API_BATCH_SIZE)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    except MemoryBudgetExceeded as mbe:
+        return _api_error(str(mbe), 413)
+    except Exception as e:
+        return _api_error(f"An internal server error occurred during analysis: {str(e)}", 500)
+
+    result_id = _documents_digest(texts)
+    result_url = url_for("api_analyze_result", result_id=result_id)
+    body = json.dumps({
+        "results": results,
+        "result_url": result_url,
+        "timing": {
+            "documents": len(texts),
+            "batch_size": API_BATCH_SIZE,
+            "inference_ms": round(elapsed_ms, 2),
+            "per_document_ms": round(elapsed_ms / len(texts), 2),
+        }
+    }).encode("utf-8")
+
+    # Results aren't guaranteed identical across runs (timing, near-duplicate reuse), so the stored body is
+    # what the GET URL serves and validates against until the next POST of the same documents replaces it
+    with api_results_lock:
+        api_results[result_id] = body
+        api_results.move_to_end(result_id)
+        while len(api_results) > API_RESULT_CACHE_SIZE:
+            api_results.popitem(last=False)
+
+    response = _json_result_response(body)
+    response.headers["Content-Location"] = result_url
+    return response
+
+@app.route("/api/analyze/<result_id>", methods=["GET"])
+def api_analyze_result(result_id: str):
+    with api_results_lock:
+        body = api_results.get(result_id)
+        if body is not None:
+            api_results.move_to_end(result_id)
+    if body is None:
+        return _api_error("Unknown or expired result; POST the documents to /api/analyze again.", 404)
+    # make_conditional answers a matching If-None-Match with 304
+    return _json_result_response(body).make_conditional(request)
+
+def _read_stream_text(raw_body: bytes, content_encoding: str) -> str:
+    texts = _extract_documents(_decode_api_body(raw_body, content_encoding))
+    if len(texts) != 1:
+        raise ValueError("Streaming accepts exactly one document.")
+    return texts[0]
+
+def _render_stream_report(text: str, analysis_result: dict) -> str:
+    # Returns the report's file name under REPORTS_FOLDER
+    return os.path.basename(pdf_pool.render(original_text=text, analysis_result=analysis_result, output_dir=REPORTS_FOLDER))
+
+@app.route("/api/stream", methods=["POST"])
+def api_stream():
+    # Server-sent events: 'sentiment' as soon as the classifier finishes, 'token' for each summary piece,
+    # then 'done' with the report download link (or 'error'). Queued streams get SSE comments as keep-alives.
+    # Each open stream holds one of this server's threads; the asyncio server on STREAM_PORT doesn't.
+    try:
+        if "file" in request.files:
+            text = request.files["file"].read().decode("utf-8")
+        else:
+            text = _read_stream_text(request.get_data(), request.headers.get("Content-Encoding", ""))
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        return _api_error(f"Malformed request body: {e}", 400)
+    except ValueError as ve:
+        return _api_error(str(ve), 400)
+
+    def events():
+        try:
+            analysis_result = None
+            for event, payload in agent.stream_analysis(text, generation_executor):
+                if event == "sentiment":
+                    yield sse_event("sentiment", payload)
+                elif event == "token":
+                    yield sse_event("token", {"text": payload})
+                elif event == "waiting":
+                    yield ": waiting for a generation worker\n\n" # SSE comment, ignored by clients
+                else:
+                    analysis_result = payload
+
+            report_name = _render_stream_report(text, analysis_result) # type: ignore [reportArgumentType]
+            yield sse_event("done", {
+                "analysis": analysis_result,
+                "report_url": url_for("download_report", filename=report_name),
+            })
+        except Exception as e:
+            yield sse_event("error", {"error": f"An internal server error occurred during analysis: {str(e)}"})
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # Stop reverse proxies from buffering the stream
+    return response
+
+@app.route("/reports/<path:filename>", methods=["GET"])
+def download_report(filename: str):
+    return send_from_directory(REPORTS_FOLDER, filename, as_attachment=True, mimetype="application/pdf")
+
+@app.route("/api/reports", methods=["POST"])
+def api_reports():
+    # Full report generation (and optional email delivery) for a batch of documents. Documents flow through
+    # the staged pipeline, so one document's inference overlaps the rendering and delivery of the previous ones.
+    try:
+        payload = _read_api_payload()
+        texts = _extract_documents(payload)
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        return _api_error(f"Malformed request body: {e}", 400)
+    except ValueError as ve:
+        return _api_error(str(ve), 400)
+
+    if len(texts) > API_MAX_DOCUMENTS:
+        return _api_error(f"Too many documents: {len(texts)} (limit is {API_MAX_DOCUMENTS}).", 413)
+
+    to_email = payload.get("to_email")
+    subject = payload.get("email_subject") or "Your Document Analysis Report"
+    start = time.perf_counter()
+    outcomes = report_pipeline.map([{"data": text, "to_email": to_email, "subject": subject} for text in texts])
+
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            results.append({"error": str(outcome)})
+            continue
+        result = {
+            "sentiment": outcome["sentiment"],
+            "confidence": outcome["confidence"],
+            "summary": outcome["summary"],
+            "reused": outcome["reused"],
+            "truncated": outcome["truncated"],
+            "analyzed_chars": outcome["analyzed_chars"],
+            "report_url": url_for("download_report", filename=os.path.basename(outcome["report_path"])),
+            "emailed": outcome["emailed"],
+        }
+        if "email_error" in outcome:
+            result["email_error"] = outcome["email_error"]
+        results.append(result)
+    return jsonify({
+        "results": results,
+        "timing": {"documents": len(texts), "total_ms": round((time.perf_counter() - start) * 1000, 2)},
+    })
+
+@app.route("/api/jobs", methods=["POST"])
+def api_enqueue_job():
+    # Hands the report off to the worker pool instead of generating it in this process
+    try:
+        texts = _extract_documents(_read_api_payload())
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        return _api_error(f"Malformed request body: {e}", 400)
+    except ValueError as ve:
+        return _api_error(str(ve), 400)
+
+    job_ids = [work_queue.enqueue({"text": text, "output_dir": REPORTS_FOLDER}) for text in texts]
+    return jsonify({"job_ids": job_ids}), 202
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+def api_job_status(job_id: int):
+    job = work_queue.get(job_id)
+    if job is None:
+        return _api_error(f"Job {job_id} not found.", 404)
+    return jsonify(job)
+
+def _is_admin() -> bool:
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(supplied, ADMIN_TOKEN) # type: ignore [reportArgumentType]
+
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    if not _is_admin():
+        return _api_error("Forbidden.", 403)
+
+    if request.method == "POST":
+        payload = request.get_json(silent=True) or {}
+        try:
+            profiler.arm(requests=payload.get("requests"), seconds=payload.get("seconds"))
+        except (TypeError, ValueError) as ve:
+            return _api_error(str(ve), 400)
+    elif request.method == "DELETE":
+        profiler.disarm()
+    return jsonify(profiler.status())
+
+@app.route("/admin/memory", methods=["GET"])
+def admin_memory():
+    # Current RSS, recent per-request memory records and recycling state
+    if not _is_admin():
+        return _api_error("Forbidden.", 403)
+    return jsonify(memory_guard.stats())
+
+@app.route("/admin/pipeline", methods=["GET"])
+def admin_pipeline():
+    # Queue depth, in-flight count and utilization per pipeline stage
+    if not _is_admin():
+        return _api_error("Forbidden.", 403)
+    return jsonify(report_pipeline.stats())
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI document analysis web service.")
+    parser.add_argument("--profile-requests", type=int, default=None, help="Profile the first N requests after startup")
+    parser.add_argument("--profile-seconds", type=float, default=None, help="Profile all requests during the first T seconds")
+    args = parser.parse_args()
+    if args.profile_requests or args.profile_seconds:
+        profiler.arm(requests=args.profile_requests, seconds=args.profile_seconds)
+
+    # Open SSE streams on this port are coroutines, not server threads (see stream_server.py).
+    # Started here rather than at import so several gunicorn workers don't compete for the port.
+    if STREAM_PORT:
+        StreamServer(agent, generation_executor, read_text=_read_stream_text, render_report=_render_stream_report,
+                     max_body_bytes=API_MAX_BODY_BYTES).start()
+
     # For production deployment with Docker, it's better to use a WSGI server like Gunicorn
     # For simple local testing with Docker, Flask's built-in server can suffice.
     # debug=False and threaded=True for better production characteristics
@@ -1,22 +1,69 @@
 # document_agent.py
 
-from transformers import AutoModelForSequenceClassification, AutoTokenizer, AutoModelForSeq2SeqLM, pipeline
+from transformers import AutoModelForSequenceClassification, AutoTokenizer, AutoModelForSeq2SeqLM, pipeline, TextStreamer, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 import torch
+import asyncio
 import os
+import threading
+import atexit
 from pdf_generator import PDFGenerator 
+from profiling import profiler
+from near_duplicate import NearDuplicateIndex, NEAR_DUP_ENABLED, NEAR_DUP_INDEX_PATH
+from memory_guard import memory_guard
 
 # Define a base directory for models *inside the Docker container*
 MODEL_BASE_DIR = os.getenv("MODEL_BASE_DIR", "/app/models") # Default to /app/models inside container
+# Seconds a streaming client waits for the next summary token before giving up
+STREAM_TOKEN_TIMEOUT = float(os.getenv("STREAM_TOKEN_TIMEOUT", 60))
+# Seconds between keep-alive events while a stream waits for a free generation worker
+STREAM_QUEUE_HEARTBEAT = float(os.getenv("STREAM_QUEUE_HEARTBEAT", 5))
+# Intra-op threads per torch op; the pool is shared by every thread running inference in this process
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", 0)) # 0 keeps torch's default (one per core)
+if TORCH_NUM_THREADS:
+    torch.set_num_threads(TORCH_NUM_THREADS)
+
+
+class CancelGeneration(StoppingCriteria):
+    # Stops model.generate at the next decoding step once the stream that started it has gone away
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class AsyncTextStreamer(TextStreamer):
+    # TextIteratorStreamer for asyncio consumers: decoded text goes to an asyncio.Queue on the consumer's loop
+    # (None marks the end), so a waiting client is a suspended coroutine instead of a blocked thread.
+    def __init__(self, tokenizer, loop, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=False, **decode_kwargs)
+        self.loop = loop
+        self.text_queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, None)
+
 
 class DocumentAgent:
-    def __init__(self):
-        # Paths for the sentiment model
-        sentiment_quantized_path = os.path.join(MODEL_BASE_DIR, 'sentiment_quantized')
-        sentiment_tokenizer_path = os.path.join(MODEL_BASE_DIR, 'sentiment_model') # Tokenizer from original download path
+    def __init__(self, sentiment_model_path=None, sentiment_tokenizer_path=None,
+                 summarizer_model_path=None, summarizer_tokenizer_path=None,
+                 torch_dtype=None, device=None, near_duplicates=None):
+        # Paths for the sentiment model (defaults to the quantized artifact; override to load another variant)
+        sentiment_quantized_path = sentiment_model_path or os.path.join(MODEL_BASE_DIR, 'sentiment_quantized')
+        sentiment_tokenizer_path = sentiment_tokenizer_path or os.path.join(MODEL_BASE_DIR, 'sentiment_model') # Tokenizer from original download path
 
         # Paths for the summarizer model
-        t5_quantized_path = os.path.join(MODEL_BASE_DIR, 't5_quantized')
-        t5_tokenizer_path = os.path.join(MODEL_BASE_DIR, 't5') # Tokenizer from original download path
+        t5_quantized_path = summarizer_model_path or os.path.join(MODEL_BASE_DIR, 't5_quantized')
+        t5_tokenizer_path = summarizer_tokenizer_path or os.path.join(MODEL_BASE_DIR, 't5') # Tokenizer from original download path
+
+        # Only forward precision/device when explicitly requested so the default load path is unchanged
+        pipeline_kwargs = {}
+        if torch_dtype is not None:
+            pipeline_kwargs["torch_dtype"] = torch_dtype
+        if device is not None:
+            pipeline_kwargs["device"] = device
 
         print(f"Loading sentiment classifier from: {sentiment_quantized_path}")
         if not os.path.exists(sentiment_quantized_path) or not os.path.exists(sentiment_tokenizer_path):
@@ -27,6 +74,7 @@ class DocumentAgent:
             "sentiment-analysis",
             model=sentiment_quantized_path,
             tokenizer=sentiment_tokenizer_path,
+            **pipeline_kwargs,
         )
         
         print(f"Loading summarizer from: {t5_quantized_path}")
@@ -38,6 +86,7 @@ class DocumentAgent:
             "summarization",
             model=t5_quantized_path,
             tokenizer=t5_tokenizer_path, 
+            **pipeline_kwargs,
         )
 
         # Define the label mapping for the new sentiment model (cardiffnlp/twitter-roberta-base-sentiment-latest)
@@ -47,9 +96,60 @@ class DocumentAgent:
             'LABEL_2': 'POSITIVE'
         }
 
+        # Reuse analyses of near-identical documents instead of re-running both models (see near_duplicate.py)
+        self.near_duplicate_index = None
+        if NEAR_DUP_ENABLED if near_duplicates is None else near_duplicates:
+            self.near_duplicate_index = NearDuplicateIndex()
+            if NEAR_DUP_INDEX_PATH:
+                if os.path.exists(NEAR_DUP_INDEX_PATH):
+                    try:
+                        self.near_duplicate_index.load(NEAR_DUP_INDEX_PATH)
+                    except Exception as e:
+                        print(f"WARNING: Could not load near-duplicate index from {NEAR_DUP_INDEX_PATH}: {e}")
+                atexit.register(self.save_near_duplicate_index)
+
+    def save_near_duplicate_index(self):
+        if self.near_duplicate_index is not None and NEAR_DUP_INDEX_PATH:
+            self.near_duplicate_index.save(NEAR_DUP_INDEX_PATH)
+
+    def _reuse_near_duplicate(self, text: str):
+        if self.near_duplicate_index is None:
+            return None
+        match = self.near_duplicate_index.lookup(text)
+        if match is None:
+            return None
+        analysis_result, similarity = match
+        print(f"Reusing analysis of a near-duplicate document (similarity {similarity:.2f}) for '{text[:50]}...'")
+        analysis_result["reused"] = True
+        analysis_result["reused_similarity"] = round(similarity, 4)
+        return analysis_result
+
+    def _remember_analysis(self, text: str, analysis_result: dict):
+        if self.near_duplicate_index is not None:
+            self.near_duplicate_index.add(text, analysis_result)
+
+    @staticmethod
+    def _note_truncation(analysis_result: dict, text: str, admitted_text: str) -> dict:
+        # A memory guard downgrade analyses only the start of the document; say so in the result
+        analysis_result["truncated"] = len(admitted_text) < len(text)
+        analysis_result["analyzed_chars"] = len(admitted_text)
+        return analysis_result
 
     def analyze_document(self, text: str) -> dict:
-        sentiment_results = self.classifier(text) 
+        reused_result = self._reuse_near_duplicate(text)
+        if reused_result is not None:
+            return self._note_truncation(reused_result, text, text)
+
+        # May truncate the input, or raise MemoryBudgetExceeded, if it would push the process over its ceiling
+        admitted_text = memory_guard.admit(text)
+        with memory_guard.track("analyze_document", len(admitted_text)):
+            # An analysis of a truncated input isn't remembered, or full-length near-duplicates would get it back
+            analysis_result = self._analyze_admitted(admitted_text, remember=len(admitted_text) == len(text))
+        return self._note_truncation(analysis_result, text, admitted_text)
+
+    def _analyze_admitted(self, text: str, remember: bool = True) -> dict:
+        with profiler.section("classify"):
+            sentiment_results = self.classifier(text) 
         
         # --- DEBUG PRINT: Inspect raw sentiment results ---
         print(f"DEBUG: Raw sentiment results for '{text[:50]}...': {sentiment_results}")
@@ -60,7 +160,8 @@ class DocumentAgent:
         # Map the generic label to a more descriptive one
         mapped_label = self.sentiment_label_map.get(sentiment["label"], sentiment["label"]) # Default to original if not found
         
-        summary_results = self.summarizer(text, max_length=150, min_length=40, do_sample=False)
+        with profiler.section("summarize"):
+            summary_results = self.summarizer(text, max_length=150, min_length=40, do_sample=False)
         
         # --- DEBUG PRINT: Inspect raw summary results ---
         print(f"DEBUG: Raw summary results for '{text[:50]}...': {summary_results}")
@@ -68,17 +169,193 @@ class DocumentAgent:
 
         summary = summary_results[0]["summary_text"] # type: ignore [reportOptionalSubscript, reportIndexIssue, reportArgumentType, reportIncompatibleVariableType]
         
-        return {
+        analysis_result = {
             "sentiment": mapped_label, # Use the mapped label here
             "confidence": sentiment["score"], # type: ignore [reportArgumentType]
             "summary": summary
         }
+        if remember:
+            self._remember_analysis(text, analysis_result)
+        analysis_result["reused"] = False
+        return analysis_result
+
+    def analyze_documents(self, texts: list, batch_size: int = 8) -> list:
+        # Batched variant of analyze_document for API callers: both pipelines see the whole list
+        # at once, so tokenization and forward passes are padded and run batch_size documents at a time.
+        results = [self._reuse_near_duplicate(text) for text in texts]
+        for text, result in zip(texts, results):
+            if result is not None:
+                self._note_truncation(result, text, text)
+        # Only documents without a near-duplicate go through the models
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        pending_texts = [memory_guard.admit(texts[i]) for i in pending]
+
+        with memory_guard.track("analyze_documents", sum(len(text) for text in pending_texts)):
+            with profiler.section("classify_batch"):
+                sentiment_results = self.classifier(pending_texts, batch_size=batch_size, truncation=True)
+            with profiler.section("summarize_batch"):
+                summary_results = self.summarizer(pending_texts, max_length=150, min_length=40, do_sample=False, batch_size=batch_size)
+
+        for i, admitted_text, sentiment, summary in zip(pending, pending_texts, sentiment_results, summary_results): # type: ignore [reportArgumentType]
+            # The summarization pipeline wraps each item in a list when given a list of inputs
+            if isinstance(summary, list):
+                summary = summary[0]
+            analysis_result = {
+                "sentiment": self.sentiment_label_map.get(sentiment["label"], sentiment["label"]), # type: ignore [reportIndexIssue]
+                "confidence": sentiment["score"], # type: ignore [reportIndexIssue]
+                "summary": summary["summary_text"] # type: ignore [reportIndexIssue]
+            }
+            if len(admitted_text) == len(texts[i]):
+                self._remember_analysis(texts[i], analysis_result)
+            analysis_result["reused"] = False
+            results[i] = self._note_truncation(analysis_result, texts[i], admitted_text)
+        return results
+
+    def classify(self, text: str) -> dict:
+        with profiler.section("classify"):
+            sentiment = self.classifier(text, truncation=True)[0] # type: ignore [reportOptionalSubscript, reportIndexIssue]
+        return {
+            "sentiment": self.sentiment_label_map.get(sentiment["label"], sentiment["label"]), # type: ignore [reportIndexIssue]
+            "confidence": sentiment["score"], # type: ignore [reportIndexIssue]
+        }
+
+    def summarize(self, text: str) -> str:
+        with profiler.section("summarize"):
+            summary_results = self.summarizer(text, max_length=150, min_length=40, do_sample=False)
+        return summary_results[0]["summary_text"] # type: ignore [reportOptionalSubscript, reportIndexIssue]
+
+    def stream_analysis(self, text: str, generation_executor):
+        # Yields ("sentiment", {...}) as soon as the classifier is done, then ("token", str) for each piece of
+        # the summary as the T5 decoder produces it, and finally ("analysis", {...}) with the full result.
+        # model.generate runs on the shared generation_executor, so streams don't each get their own thread.
+        reused_result = self._reuse_near_duplicate(text)
+        if reused_result is not None:
+            yield "sentiment", {"sentiment": reused_result["sentiment"], "confidence": reused_result["confidence"]}
+            yield "token", reused_result["summary"]
+            yield "analysis", self._note_truncation(reused_result, text, text)
+            return
+
+        admitted_text = memory_guard.admit(text)
+        with memory_guard.track("stream_analysis", len(admitted_text)):
+            events = self._stream_admitted(admitted_text, generation_executor)
+            try:
+                for event, payload in events:
+                    if event == "analysis":
+                        self._note_truncation(payload, text, admitted_text)
+                    yield event, payload
+            finally:
+                events.close() # Propagates a client disconnect so the generation is cancelled
+
+    def _start_summary_stream(self, text: str, generation_executor, streamer, cancelled: threading.Event, started: threading.Event):
+        # Submits greedy T5 generation feeding `streamer`; it stops early once `cancelled` is set
+        model = self.summarizer.model
+        tokenizer = self.summarizer.tokenizer
+        # The summarization pipeline copies T5's task prefix ("summarize: ") into the model config
+        prefix = getattr(model.config, "prefix", None) or ""
+        inputs = tokenizer(prefix + text, return_tensors="pt", truncation=True).to(model.device) # type: ignore [reportOptionalCall]
+
+        def generate():
+            if cancelled.is_set():
+                return # The stream went away while this job was queued
+            started.set()
+            try:
+                # The pipeline also copies t5-small's num_beams=4, and generate() refuses a streamer under beam search,
+                # so the streamed summary is greedy and can differ slightly from analyze_document's
+                model.generate(**inputs, max_length=150, min_length=40, do_sample=False, num_beams=1, streamer=streamer, # type: ignore [reportCallIssue]
+                               stopping_criteria=StoppingCriteriaList([CancelGeneration(cancelled)]))
+            except Exception:
+                # Unblock the consumer; the error itself surfaces through the future
+                streamer.end()
+                raise
+
+        return generation_executor.submit(generate)
+
+    def _stream_admitted(self, text: str, generation_executor):
+        sentiment_result = self.classify(text)
+        yield "sentiment", sentiment_result
+
+        streamer = TextIteratorStreamer(self.summarizer.tokenizer, skip_special_tokens=True, timeout=STREAM_TOKEN_TIMEOUT) # type: ignore [reportArgumentType]
+        cancelled = threading.Event()
+        started = threading.Event()
+        generation = self._start_summary_stream(text, generation_executor, streamer, cancelled, started)
+        pieces = []
+        try:
+            # Waiting for a free generation worker doesn't count against the token timeout. The keep-alives
+            # also let the server notice a client that disconnected while queued.
+            while not started.wait(STREAM_QUEUE_HEARTBEAT):
+                yield "waiting", None
+            for piece in streamer:
+                if piece:
+                    pieces.append(piece)
+                    yield "token", piece
+            generation.result()
+        finally:
+            # Normal end, token timeout or client disconnect (GeneratorExit): free the generation worker
+            cancelled.set()
+            generation.cancel()
+
+        # Not remembered: near-duplicate reuse should only hand out the beam-search summaries analyze_document makes
+        analysis_result = dict(sentiment_result, summary="".join(pieces).strip())
+        analysis_result["reused"] = False
+        yield "analysis", analysis_result
+
+    async def astream_analysis(self, text: str, generation_executor):
+        # Async generator with the same events as stream_analysis, for the asyncio stream server
+        loop = asyncio.get_running_loop()
+        reused_result = self._reuse_near_duplicate(text)
+        if reused_result is not None:
+            yield "sentiment", {"sentiment": reused_result["sentiment"], "confidence": reused_result["confidence"]}
+            yield "token", reused_result["summary"]
+            yield "analysis", self._note_truncation(reused_result, text, text)
+            return
+
+        original_text, text = text, memory_guard.admit(text)
+        with memory_guard.track("stream_analysis", len(text)):
+            sentiment_result = await loop.run_in_executor(None, self.classify, text)
+            yield "sentiment", sentiment_result
+
+            streamer = AsyncTextStreamer(self.summarizer.tokenizer, loop, skip_special_tokens=True)
+            cancelled = threading.Event()
+            started = threading.Event()
+            generation = self._start_summary_stream(text, generation_executor, streamer, cancelled, started)
+            pieces = []
+            try:
+                while True:
+                    # Same rule as the threaded path: the token timeout only runs once generation has started
+                    was_started = started.is_set()
+                    try:
+                        piece = await asyncio.wait_for(streamer.text_queue.get(), STREAM_TOKEN_TIMEOUT if was_started else STREAM_QUEUE_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        if was_started:
+                            raise TimeoutError(f"No summary token within {STREAM_TOKEN_TIMEOUT:.0f}s.")
+                        yield "waiting", None
+                        continue
+                    if piece is None:
+                        break
+                    if piece:
+                        pieces.append(piece)
+                        yield "token", piece
+                await asyncio.wrap_future(generation)
+            finally:
+                cancelled.set()
+                generation.cancel()
+
+        analysis_result = dict(sentiment_result, summary="".join(pieces).strip())
+        analysis_result["reused"] = False
+        yield "analysis", self._note_truncation(analysis_result, original_text, text)
 
-    def generate_report(self, text: str, output_dir: str = "reports") -> str:
+    def generate_report(self, text: str, output_dir: str = "reports", pdf_pool=None) -> str:
         analysis_result = self.analyze_document(text)
-        pdf = PDFGenerator()
         
-        pdf_report_path = pdf.build(original_text=text, analysis_result=analysis_result, output_dir=output_dir)
+        with profiler.section("render_pdf"):
+            if pdf_pool is not None:
+                # Layout runs in a render worker process; this thread just waits without holding the GIL
+                pdf_report_path = pdf_pool.render(original_text=text, analysis_result=analysis_result, output_dir=output_dir)
+            else:
+                pdf = PDFGenerator()
+                pdf_report_path = pdf.build(original_text=text, analysis_result=analysis_result, output_dir=output_dir)
         print(f"Report for '{text[:50]}...' saved to '{output_dir}'.")
         return pdf_report_path
 
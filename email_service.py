@@ -14,6 +14,8 @@ class EmailService:
         self.smtp_port = int(os.getenv("SMTP_PORT", 587))
         self.username = os.getenv("SMTP_USERNAME")
         self.password = os.getenv("SMTP_PASSWORD")
+        # Disable only for local test sinks (e.g. `python load_test.py smtp-sink`) that don't speak TLS
+        self.use_starttls = os.getenv("SMTP_STARTTLS", "1") != "0"
 
     def send_email(self, to_email: str, subject: str, body: str, attachment_path: str):
         # This check ensures username and password are not None before use
@@ -39,7 +41,8 @@ class EmailService:
         
         try:
             with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()  # Upgrade the connection to a secure encrypted SSL/TLS connection
+                if self.use_starttls:
+                    server.starttls()  # Upgrade the connection to a secure encrypted SSL/TLS connection
                 # Pylance fix: Explicitly cast to str after the None check
                 server.login(str(self.username), str(self.password)) 
                 server.send_message(msg)
@@ -0,0 +1,315 @@
+# evaluate_models.py
+#
+# Offline, CPU-only comparison of model precision variants (fp32, bf16, int8) on a labeled local dataset.
+# Each variant runs through DocumentAgent in its own process so peak RSS is measured in isolation.
+#
+# Dataset format (JSONL, one document per line):
+#   {"text": "...", "label": "POSITIVE", "summary": "reference summary ..."}
+#
+# Usage:
+#   python evaluate_models.py eval_data.jsonl
+#   python evaluate_models.py eval_data.jsonl --variants fp32 int8-dynamic --output eval_results.json
+#   python evaluate_models.py eval_data.jsonl --baseline fp32 --candidate int8-dynamic --max-accuracy-drop 0.02
+
+import os
+
+# Never reach out to the Hub and never pick up a GPU: results must be reproducible on a plain CPU box
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import io
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import time
+
+from stats_utils import percentile
+
+MODEL_BASE_DIR = os.getenv("MODEL_BASE_DIR", "/app/models")
+
+SENTIMENT_LABELS = ["NEGATIVE", "NEUTRAL", "POSITIVE"]
+
+# Each variant names the artifact directories it loads and how the weights are prepared after loading
+VARIANTS = {
+    "fp32": {
+        "sentiment_model": "sentiment_model",
+        "summarizer_model": "t5",
+        "torch_dtype": "float32",
+        "dynamic_int8": False,
+    },
+    "bf16": {
+        "sentiment_model": "sentiment_model",
+        "summarizer_model": "t5",
+        "torch_dtype": "bfloat16",
+        "dynamic_int8": False,
+    },
+    # torch dynamic quantization of nn.Linear layers: int8 weights that run on any CPU
+    "int8-dynamic": {
+        "sentiment_model": "sentiment_model",
+        "summarizer_model": "t5",
+        "torch_dtype": "float32",
+        "dynamic_int8": True,
+    },
+    # The artifacts produced by quantize_models.py (BitsAndBytesConfig(load_in_8bit=True)).
+    # bitsandbytes usually needs a GPU, so this variant is reported as skipped if it can't load on CPU.
+    "int8-bnb": {
+        "sentiment_model": "sentiment_quantized",
+        "summarizer_model": "t5_quantized",
+        "torch_dtype": None,
+        "dynamic_int8": False,
+    },
+}
+
+
+def load_dataset(path: str) -> list:
+    examples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not record.get("text"):
+                raise ValueError(f"{path}:{line_number}: missing 'text'")
+            examples.append({
+                "text": record["text"],
+                "label": str(record.get("label") or "").upper() or None,
+                "summary": record.get("summary") or record.get("reference"),
+            })
+    if not examples:
+        raise ValueError(f"No examples found in {path}")
+    return examples
+
+
+def variant_available(name: str) -> bool:
+    spec = VARIANTS[name]
+    # Tokenizers always come from the original download directories
+    required = {spec["sentiment_model"], spec["summarizer_model"], "sentiment_model", "t5"}
+    return all(os.path.exists(os.path.join(MODEL_BASE_DIR, directory)) for directory in required)
+
+
+# --- Metrics ---
+
+def _tokens(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+def _f1(overlap: int, candidate_total: int, reference_total: int) -> float:
+    if overlap == 0 or candidate_total == 0 or reference_total == 0:
+        return 0.0
+    precision = overlap / candidate_total
+    recall = overlap / reference_total
+    return 2 * precision * recall / (precision + recall)
+
+def rouge_1(candidate: str, reference: str) -> float:
+    candidate_tokens, reference_tokens = _tokens(candidate), _tokens(reference)
+    reference_counts = {}
+    for token in reference_tokens:
+        reference_counts[token] = reference_counts.get(token, 0) + 1
+    overlap = 0
+    for token in candidate_tokens:
+        if reference_counts.get(token, 0) > 0:
+            reference_counts[token] -= 1
+            overlap += 1
+    return _f1(overlap, len(candidate_tokens), len(reference_tokens))
+
+def rouge_l(candidate: str, reference: str) -> float:
+    candidate_tokens, reference_tokens = _tokens(candidate), _tokens(reference)
+    # Longest common subsequence, one row at a time
+    previous = [0] * (len(reference_tokens) + 1)
+    for candidate_token in candidate_tokens:
+        current = [0]
+        for j, reference_token in enumerate(reference_tokens, start=1):
+            if candidate_token == reference_token:
+                current.append(previous[j - 1] + 1)
+            else:
+                current.append(max(previous[j], current[j - 1]))
+        previous = current
+    return _f1(previous[-1], len(candidate_tokens), len(reference_tokens))
+
+def macro_f1(predictions: list, labels: list) -> float:
+    scores = []
+    for label in SENTIMENT_LABELS:
+        true_positive = sum(1 for p, l in zip(predictions, labels) if p == label and l == label)
+        predicted = sum(1 for p in predictions if p == label)
+        actual = sum(1 for l in labels if l == label)
+        if actual == 0 and predicted == 0:
+            continue
+        scores.append(_f1(true_positive, predicted, actual))
+    return sum(scores) / len(scores) if scores else 0.0
+
+def serialized_size_bytes(model) -> int:
+    # Size of the weights as they actually sit in memory for this variant (works for packed int8 modules too)
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+# --- Per-variant run (executed in a fresh process) ---
+
+def _run_variant(name: str, examples: list, result_queue):
+    try:
+        import torch
+        from document_agent import DocumentAgent
+
+        spec = VARIANTS[name]
+        agent = DocumentAgent(
+            sentiment_model_path=os.path.join(MODEL_BASE_DIR, spec["sentiment_model"]),
+            sentiment_tokenizer_path=os.path.join(MODEL_BASE_DIR, "sentiment_model"),
+            summarizer_model_path=os.path.join(MODEL_BASE_DIR, spec["summarizer_model"]),
+            summarizer_tokenizer_path=os.path.join(MODEL_BASE_DIR, "t5"),
+            torch_dtype=getattr(torch, spec["torch_dtype"]) if spec["torch_dtype"] else None,
+            device=-1,
+            near_duplicates=False, # Every example must actually go through the variant under test
+        )
+        if spec["dynamic_int8"]:
+            agent.classifier.model = torch.ao.quantization.quantize_dynamic(agent.classifier.model, {torch.nn.Linear}, dtype=torch.qint8)
+            agent.summarizer.model = torch.ao.quantization.quantize_dynamic(agent.summarizer.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        model_size = serialized_size_bytes(agent.classifier.model) + serialized_size_bytes(agent.summarizer.model)
+
+        # One warm-up call so lazy initialisation doesn't land in the first latency sample
+        agent.analyze_document(examples[0]["text"])
+
+        latencies_ms, predictions = [], []
+        for example in examples:
+            start = time.perf_counter()
+            predictions.append(agent.analyze_document(example["text"]))
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        labeled = [(p["sentiment"], e["label"]) for p, e in zip(predictions, examples) if e["label"]]
+        summarized = [(p["summary"], e["summary"]) for p, e in zip(predictions, examples) if e["summary"]]
+
+        result_queue.put({
+            "variant": name,
+            "status": "ok",
+            "examples": len(examples),
+            "accuracy": sum(1 for p, l in labeled if p == l) / len(labeled) if labeled else None,
+            "macro_f1": macro_f1([p for p, _ in labeled], [l for _, l in labeled]) if labeled else None,
+            "rouge1": sum(rouge_1(c, r) for c, r in summarized) / len(summarized) if summarized else None,
+            "rougeL": sum(rouge_l(c, r) for c, r in summarized) / len(summarized) if summarized else None,
+            "latency_p50_ms": percentile(latencies_ms, 50),
+            "latency_p90_ms": percentile(latencies_ms, 90),
+            "latency_p99_ms": percentile(latencies_ms, 99),
+            "model_size_mb": model_size / (1024 * 1024),
+            # ru_maxrss is reported in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+    except Exception as e:
+        result_queue.put({"variant": name, "status": f"skipped: {e}"})
+
+
+def evaluate_variant(name: str, examples: list) -> dict:
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=_run_variant, args=(name, examples, result_queue))
+    process.start()
+    process.join()
+    if result_queue.empty():
+        return {"variant": name, "status": f"skipped: worker exited with code {process.exitcode}"}
+    return result_queue.get()
+
+
+# --- Reporting ---
+
+COLUMNS = [
+    ("variant", "Variant", "{}"),
+    ("accuracy", "Acc", "{:.3f}"),
+    ("macro_f1", "F1", "{:.3f}"),
+    ("rouge1", "ROUGE-1", "{:.3f}"),
+    ("rougeL", "ROUGE-L", "{:.3f}"),
+    ("latency_p50_ms", "p50 ms", "{:.1f}"),
+    ("latency_p90_ms", "p90 ms", "{:.1f}"),
+    ("latency_p99_ms", "p99 ms", "{:.1f}"),
+    ("model_size_mb", "Size MB", "{:.1f}"),
+    ("peak_rss_mb", "Peak RSS MB", "{:.1f}"),
+]
+
+def format_table(results: list) -> str:
+    rows = [[title for _, title, _ in COLUMNS]]
+    for result in results:
+        if result["status"] != "ok":
+            rows.append([result["variant"], result["status"]] + [""] * (len(COLUMNS) - 2))
+            continue
+        rows.append([
+            fmt.format(result[key]) if result.get(key) is not None else "-"
+            for key, _, fmt in COLUMNS
+        ])
+    widths = [max(len(row[i]) for row in rows if i < len(row)) for i in range(len(COLUMNS))]
+    # Let a long skip reason spill over instead of widening the whole column
+    widths[1] = max(len(row[1]) for row in rows if not row[1].startswith("skipped"))
+    lines = []
+    for row in rows:
+        lines.append("  ".join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+def check_gate(results: list, baseline: str, candidate: str, max_accuracy_drop: float, max_rouge_drop: float) -> list:
+    by_name = {r["variant"]: r for r in results}
+    failures = []
+    for name in (baseline, candidate):
+        if by_name.get(name, {}).get("status") != "ok":
+            failures.append(f"{name} did not run successfully")
+    if failures:
+        return failures
+
+    base, cand = by_name[baseline], by_name[candidate]
+    for metric, limit in (("accuracy", max_accuracy_drop), ("macro_f1", max_accuracy_drop), ("rougeL", max_rouge_drop)):
+        if base[metric] is None or cand[metric] is None:
+            continue
+        drop = base[metric] - cand[metric]
+        if drop > limit:
+            failures.append(f"{metric} dropped by {drop:.3f} ({base[metric]:.3f} -> {cand[metric]:.3f}), limit {limit:.3f}")
+    return failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare accuracy, latency and memory of model precision variants.")
+    parser.add_argument("dataset", help="Labeled JSONL file with text/label/summary fields")
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=list(VARIANTS),
+                        help="Variants to evaluate (default: every variant whose artifacts exist)")
+    parser.add_argument("--limit", type=int, default=None, help="Only evaluate the first N examples")
+    parser.add_argument("--output", help="Also write the raw results as JSON to this path")
+    parser.add_argument("--baseline", default="fp32", help="Reference variant for the promotion gate")
+    parser.add_argument("--candidate", help="Variant to gate against the baseline; exit code 1 if it regresses too much")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.02)
+    parser.add_argument("--max-rouge-drop", type=float, default=0.02)
+    args = parser.parse_args(argv)
+
+    examples = load_dataset(args.dataset)
+    if args.limit:
+        examples = examples[:args.limit]
+    print(f"Loaded {len(examples)} examples from {args.dataset}")
+
+    results = []
+    for name in args.variants:
+        if not variant_available(name):
+            results.append({"variant": name, "status": "skipped: artifacts not found"})
+            continue
+        print(f"\nEvaluating variant '{name}'...")
+        results.append(evaluate_variant(name, examples))
+
+    print("\n" + format_table(results))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nRaw results written to {args.output}")
+
+    if args.candidate:
+        failures = check_gate(results, args.baseline, args.candidate, args.max_accuracy_drop, args.max_rouge_drop)
+        if failures:
+            print(f"\nPromotion gate FAILED for '{args.candidate}' vs '{args.baseline}':")
+            for failure in failures:
+                print(f"  - {failure}")
+            return 1
+        print(f"\nPromotion gate passed for '{args.candidate}' vs '{args.baseline}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,400 @@
+# load_test.py
+#
+# Open-loop load generator for the Flask service. Replays a JSONL request log against a running app at a
+# fixed, Poisson or recorded arrival rate, with a configurable mix of document sizes, and records latency
+# percentiles, error rate and throughput over time. Latency is measured from each request's *scheduled*
+# send time, so a saturated server shows up as growing latency instead of a silently lower request rate.
+# The timeline buckets requests by the second they *completed* in, so it shows delivered throughput; 'sent'
+# is the offered load scheduled in that second.
+#
+# Request log format (JSONL, one request per line; every field is optional except some text source):
+#   {"ts": 1719999999.5, "endpoint": "/api/analyze", "text": "...", "to_email": "a@example.com"}
+#   {"file": "product1.txt"}            # text read from a local file
+#   {"title": "...", "body": "..."}     # 'body' is used as the document text
+#
+# Usage:
+#   python load_test.py smtp-sink --port 1025
+#   SMTP_SERVER=127.0.0.1 SMTP_PORT=1025 SMTP_STARTTLS=0 SMTP_USERNAME=load SMTP_PASSWORD=test python app.py
+#   python load_test.py run --log traffic.jsonl --arrival poisson --rate 2 --duration 120 --output baseline.json
+#   python load_test.py run --log traffic.jsonl --arrival poisson --rate 2 --duration 120 --output candidate.json
+#   python load_test.py compare baseline.json candidate.json --max-p95-regression 0.10
+
+import argparse
+import base64
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from stats_utils import percentile
+
+DEFAULT_SAMPLE_FILES = ("product1.txt", "product2.txt")
+
+
+# --- Local SMTP sink ---
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA) for EmailService to deliver into the void
+
+    def _reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def _read_line(self) -> str:
+        return self.rfile.readline().decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def handle(self):
+        self._reply("220 load-test SMTP sink ready")
+        while True:
+            line = self._read_line()
+            command = line.split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self._reply("250-load-test-sink")
+                self._reply("250-AUTH PLAIN LOGIN")
+                self._reply("250 8BITMIME")
+            elif command == "AUTH":
+                parts = line.split()
+                mechanism = parts[1].upper() if len(parts) > 1 else ""
+                if mechanism == "PLAIN" and len(parts) < 3:
+                    self._reply("334 ")
+                    self._read_line()
+                elif mechanism == "LOGIN":
+                    if len(parts) < 3:
+                        self._reply("334 " + base64.b64encode(b"Username:").decode())
+                        self._read_line()
+                    self._reply("334 " + base64.b64encode(b"Password:").decode())
+                    self._read_line()
+                self._reply("235 Authentication successful")
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self._reply("250 OK")
+            elif command == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    size += len(data_line)
+                self.server.record_message(size) # type: ignore [reportAttributeAccessIssue]
+                self._reply("250 Message accepted")
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            elif not line:
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 1025):
+        super().__init__((host, port), _SMTPSinkHandler)
+        self.messages = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def record_message(self, size: int):
+        with self._lock:
+            self.messages += 1
+            self.bytes_received += size
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        print(f"SMTP sink listening on {self.server_address[0]}:{self.server_address[1]}")
+        return self
+
+
+# --- Workload ---
+
+def load_request_log(path, endpoint: str) -> list:
+    entries = []
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                text = record.get("text") or record.get("body")
+                if not text and record.get("file"):
+                    with open(record["file"], "r", encoding="utf-8") as text_file:
+                        text = text_file.read()
+                if not text:
+                    continue
+                entries.append({
+                    "ts": record.get("ts"),
+                    "endpoint": record.get("endpoint", endpoint),
+                    "text": text,
+                    "to_email": record.get("to_email"),
+                })
+    else:
+        for sample_file in DEFAULT_SAMPLE_FILES:
+            if os.path.exists(sample_file):
+                with open(sample_file, "r", encoding="utf-8") as f:
+                    entries.append({"ts": None, "endpoint": endpoint, "text": f.read(), "to_email": None})
+    if not entries:
+        raise ValueError("No requests to replay: pass --log or run from the repo root so the sample files are found.")
+    return entries
+
+
+def parse_size_mix(spec: str) -> list:
+    # "1:0.6,4:0.3,16:0.1" -> documents are repeated 1x, 4x or 16x with those probabilities
+    mix = []
+    for part in spec.split(","):
+        factor, weight = part.split(":")
+        mix.append((int(factor), float(weight)))
+    return mix
+
+
+def build_schedule(entries: list, arrival: str, rate: float, duration: float, speed: float, seed: int) -> list:
+    # Returns [(offset_seconds, entry)] in send order
+    rng = random.Random(seed)
+    schedule = []
+    if arrival == "recorded":
+        timestamps = [e["ts"] for e in entries]
+        if any(ts is None for ts in timestamps):
+            raise ValueError("--arrival recorded needs a 'ts' field on every log entry.")
+        start = min(timestamps)
+        for entry in sorted(entries, key=lambda e: e["ts"]):
+            offset = (entry["ts"] - start) / speed
+            if duration and offset > duration:
+                break
+            schedule.append((offset, entry))
+        return schedule
+
+    offset, index = 0.0, 0
+    while offset < duration:
+        schedule.append((offset, entries[index % len(entries)]))
+        index += 1
+        offset += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+    return schedule
+
+
+def _multipart_body(fields: dict, file_text: str) -> tuple:
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines += [f"--{boundary}", f'Content-Disposition: form-data; name="{name}"', "", value]
+    lines += [f"--{boundary}", 'Content-Disposition: form-data; name="file"; filename="document.txt"', "Content-Type: text/plain", "", file_text, f"--{boundary}--", ""]
+    return "\r\n".join(lines).encode("utf-8"), f"multipart/form-data; boundary={boundary}"
+
+
+def build_request(base_url: str, entry: dict, size_factor: int, email_fraction: float, rng: random.Random) -> urllib.request.Request:
+    text = " ".join([entry["text"].strip()] * size_factor)
+    to_email = entry["to_email"] or ("load-test@example.com" if rng.random() < email_fraction else None)
+    if to_email or entry["endpoint"] == "/":
+        # Email delivery only exists on the HTML form endpoint
+        fields = {"to_email": to_email or "", "email_subject": "Load test report"}
+        body, content_type = _multipart_body(fields, text)
+        return urllib.request.Request(base_url.rstrip("/") + "/", data=body, headers={"Content-Type": content_type}, method="POST")
+    body = json.dumps({"text": text}).encode("utf-8")
+    return urllib.request.Request(base_url.rstrip("/") + entry["endpoint"], data=body, headers={"Content-Type": "application/json"}, method="POST")
+
+
+# --- Run ---
+
+def _latency_summary(samples: list) -> dict:
+    latencies = [s["latency_ms"] for s in samples if s["ok"]]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s["ok"]),
+        "error_rate": (sum(1 for s in samples if not s["ok"]) / len(samples)) if samples else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies) if latencies else 0.0,
+    }
+
+
+def run_load(args) -> dict:
+    rng = random.Random(args.seed)
+    entries = load_request_log(args.log, args.endpoint)
+    size_mix = parse_size_mix(args.size_mix)
+    schedule = build_schedule(entries, args.arrival, args.rate, args.duration, args.speed, args.seed)
+    print(f"Replaying {len(schedule)} requests ({args.arrival} arrivals) against {args.url}")
+
+    samples = []
+    samples_lock = threading.Lock()
+
+    def send(scheduled_at: float, offset: float, request: urllib.request.Request, size_factor: int):
+        status, ok, error = None, False, None
+        try:
+            with urllib.request.urlopen(request, timeout=args.timeout) as response:
+                response.read()
+                status = response.status
+                # The HTML endpoint reports failures as a 200 page; a successful run always returns the PDF
+                ok = status < 400 and (request.full_url.rstrip("/") != args.url.rstrip("/") or response.headers.get_content_type() == "application/pdf")
+        except urllib.error.HTTPError as e:
+            status, error = e.code, str(e)
+        except Exception as e:
+            error = str(e)
+        finished = time.perf_counter()
+        with samples_lock:
+            samples.append({
+                "offset_s": offset,
+                "finish_s": offset + (finished - scheduled_at),
+                "latency_ms": (finished - scheduled_at) * 1000,
+                "status": status,
+                "ok": ok,
+                "error": error,
+                "size_factor": size_factor,
+            })
+
+    # Open loop: requests are fired on schedule no matter how many are still outstanding
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    start = time.perf_counter()
+    for offset, entry in schedule:
+        size_factor = rng.choices([f for f, _ in size_mix], weights=[w for _, w in size_mix])[0]
+        request = build_request(args.url, entry, size_factor, args.email_fraction, rng)
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(send, start + offset, offset, request, size_factor)
+    executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+
+    timeline = []
+    for second in range(int(elapsed) + 1):
+        sent = sum(1 for s in samples if int(s["offset_s"]) == second)
+        completed = [s for s in samples if int(s["finish_s"]) == second]
+        if sent or completed:
+            summary = _latency_summary(completed)
+            timeline.append({"second": second, "sent": sent, "completed": len(completed), "ok": len(completed) - summary["errors"], "errors": summary["errors"], "p95_ms": summary["p95_ms"]})
+
+    by_size = {}
+    for factor, _ in size_mix:
+        by_size[str(factor)] = _latency_summary([s for s in samples if s["size_factor"] == factor])
+
+    overall = _latency_summary(samples)
+    overall["duration_s"] = elapsed
+    overall["throughput_rps"] = (overall["requests"] - overall["errors"]) / elapsed if elapsed else 0.0
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "func"},
+        "overall": overall,
+        "by_size_factor": by_size,
+        "timeline": timeline,
+        "errors": sorted({s["error"] for s in samples if s["error"]})[:20],
+    }
+
+
+def print_summary(result: dict):
+    overall = result["overall"]
+    print(f"\n{overall['requests']} requests in {overall['duration_s']:.1f}s, {overall['throughput_rps']:.2f} ok req/s, error rate {overall['error_rate']:.1%}")
+    print(f"latency p50 {overall['p50_ms']:.0f} ms, p90 {overall['p90_ms']:.0f} ms, p95 {overall['p95_ms']:.0f} ms, p99 {overall['p99_ms']:.0f} ms, max {overall['max_ms']:.0f} ms")
+    for factor, summary in result["by_size_factor"].items():
+        if summary["requests"]:
+            print(f"  size x{factor}: {summary['requests']} requests, p50 {summary['p50_ms']:.0f} ms, p95 {summary['p95_ms']:.0f} ms, errors {summary['errors']}")
+    if "smtp_sink" in result:
+        print(f"SMTP sink received {result['smtp_sink']['messages']} messages")
+    for error in result["errors"]:
+        print(f"  error: {error}")
+
+
+# --- Compare ---
+
+COMPARE_METRICS = [
+    ("throughput_rps", "Throughput (ok req/s)", True),
+    ("error_rate", "Error rate", False),
+    ("p50_ms", "p50 latency (ms)", False),
+    ("p90_ms", "p90 latency (ms)", False),
+    ("p95_ms", "p95 latency (ms)", False),
+    ("p99_ms", "p99 latency (ms)", False),
+    ("max_ms", "Max latency (ms)", False),
+]
+
+def compare_runs(baseline: dict, candidate: dict, max_p95_regression=None, max_error_rate_increase=None) -> int:
+    print(f"{'Metric':<24}{'Baseline':>14}{'Candidate':>14}{'Change':>10}")
+    for key, title, higher_is_better in COMPARE_METRICS:
+        a, b = baseline["overall"][key], candidate["overall"][key]
+        change = f"{(b - a) / a:+.1%}" if a else "n/a"
+        marker = ""
+        if a and b != a and ((b > a) != higher_is_better):
+            marker = "  worse"
+        print(f"{title:<24}{a:>14.3f}{b:>14.3f}{change:>10}{marker}")
+
+    failures = []
+    base_p95, cand_p95 = baseline["overall"]["p95_ms"], candidate["overall"]["p95_ms"]
+    if max_p95_regression is not None and base_p95 and (cand_p95 - base_p95) / base_p95 > max_p95_regression:
+        failures.append(f"p95 latency regressed by {(cand_p95 - base_p95) / base_p95:.1%} (limit {max_p95_regression:.1%})")
+    error_increase = candidate["overall"]["error_rate"] - baseline["overall"]["error_rate"]
+    if max_error_rate_increase is not None and error_increase > max_error_rate_increase:
+        failures.append(f"error rate increased by {error_increase:.2%} (limit {max_error_rate_increase:.2%})")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the document analysis service.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Replay a request log against a running app")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    run_parser.add_argument("--log", help="JSONL request log (default: product1.txt/product2.txt)")
+    run_parser.add_argument("--endpoint", default="/api/analyze", help="Endpoint for log entries that don't name one")
+    run_parser.add_argument("--arrival", choices=["constant", "poisson", "recorded"], default="constant")
+    run_parser.add_argument("--rate", type=float, default=1.0, help="Requests per second for constant/poisson arrivals")
+    run_parser.add_argument("--duration", type=float, default=60.0, help="Seconds of traffic to generate")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="Time compression for recorded arrivals (2 = twice as fast)")
+    run_parser.add_argument("--size-mix", default="1:1", help="Document size multipliers and weights, e.g. 1:0.6,4:0.3,16:0.1")
+    run_parser.add_argument("--email-fraction", type=float, default=0.0, help="Fraction of requests sent with a recipient email")
+    run_parser.add_argument("--smtp-sink-port", type=int, default=None, help="Also run a local SMTP sink on this port")
+    run_parser.add_argument("--concurrency", type=int, default=256, help="Max requests in flight")
+    run_parser.add_argument("--timeout", type=float, default=300.0)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="Write the full results as JSON (input for 'compare')")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two saved runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--max-p95-regression", type=float, default=None, help="e.g. 0.10 fails if p95 grew more than 10%%")
+    compare_parser.add_argument("--max-error-rate-increase", type=float, default=None)
+
+    sink_parser = subparsers.add_parser("smtp-sink", help="Run only the local SMTP sink")
+    sink_parser.add_argument("--host", default="127.0.0.1")
+    sink_parser.add_argument("--port", type=int, default=1025)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "smtp-sink":
+        sink = SMTPSink(args.host, args.port)
+        print(f"SMTP sink listening on {args.host}:{args.port} (Ctrl+C to stop)")
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            print(f"\nReceived {sink.messages} messages ({sink.bytes_received} bytes)")
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.candidate, "r", encoding="utf-8") as f:
+            candidate = json.load(f)
+        return compare_runs(baseline, candidate, args.max_p95_regression, args.max_error_rate_increase)
+
+    sink = SMTPSink(port=args.smtp_sink_port).start() if args.smtp_sink_port else None
+    result = run_load(args)
+    if sink is not None:
+        result["smtp_sink"] = {"messages": sink.messages, "bytes": sink.bytes_received}
+        sink.shutdown()
+    print_summary(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+# memory_guard.py
+#
+# Memory guardrails for long-running processes that hold DocumentAgent (the Flask app and worker.py).
+#
+# - Accounting: track() records each request's RSS before/after, the peak RSS seen while it ran (sampled in
+#   the background) and, on GPU, the torch allocator's peak. Recent records are kept for /admin/memory.
+# - Ceiling: admit() projects a request's peak from its input size (bytes per character learned from past
+#   requests) and rejects it, or truncates the input to fit, when the projection exceeds MEMORY_CEILING_MB.
+# - Recycling: after RECYCLE_AFTER_REQUESTS requests, or once RSS crosses RECYCLE_RSS_MB, the process stops
+#   taking new work, waits for in-flight requests to finish and re-executes itself. Model weights are loaded
+#   from memory-mapped safetensors files that are still in the OS page cache, so the restart is cheap.
+
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+
+from werkzeug.wsgi import ClosingIterator
+
+MEMORY_CEILING_MB = float(os.getenv("MEMORY_CEILING_MB", 0)) # 0 disables the per-request ceiling
+MEMORY_OVER_CEILING = os.getenv("MEMORY_OVER_CEILING", "downgrade") # "downgrade" (truncate input) or "reject"
+MEMORY_MIN_INPUT_CHARS = int(os.getenv("MEMORY_MIN_INPUT_CHARS", 2000)) # Never truncate below this; reject instead
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", 0.05))
+RECYCLE_AFTER_REQUESTS = int(os.getenv("RECYCLE_AFTER_REQUESTS", 0)) # 0 disables request-count recycling
+RECYCLE_RSS_MB = float(os.getenv("RECYCLE_RSS_MB", 0)) # 0 disables RSS-based recycling
+RECYCLE_DRAIN_TIMEOUT = float(os.getenv("RECYCLE_DRAIN_TIMEOUT", 120)) # Seconds to wait for in-flight work
+RECYCLE_ACTION = os.getenv("RECYCLE_ACTION", "exec") # "exec" re-executes in place; "signal" sends SIGTERM (gunicorn respawns)
+
+_MB = 1024 * 1024
+# Below this size a request's memory is mostly fixed overhead, so it says little about cost per character
+_MIN_LEARNING_CHARS = 1000
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def current_rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak rather than current RSS, but the best the stdlib offers elsewhere (kilobytes on Linux)
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _torch_cuda():
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+class _Tracking:
+    def __init__(self, guard, label: str, chars: int):
+        self.guard = guard
+        self.label = label
+        self.chars = chars
+        self.peak_rss = 0
+        self.overlapped = False
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.rss_before = current_rss_bytes()
+        self.peak_rss = self.rss_before
+        cuda = _torch_cuda()
+        with self.guard._lock:
+            if self.guard._active:
+                # The allocator's peak counter is process-wide: resetting it now would wipe the peaks of the
+                # requests already running, so overlapping requests share (and over-report) one peak instead
+                self.overlapped = True
+                for tracking in self.guard._active:
+                    tracking.overlapped = True
+            elif cuda is not None:
+                cuda.reset_peak_memory_stats()
+            self.guard._active.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        rss_after = current_rss_bytes()
+        cuda = _torch_cuda()
+        torch_peak = cuda.max_memory_allocated() if cuda is not None else None
+        with self.guard._lock:
+            self.guard._active.discard(self)
+            self.guard._requests += 1
+            self.peak_rss = max(self.peak_rss, rss_after)
+            record = {
+                "label": self.label,
+                "chars": self.chars,
+                "rss_before_mb": round(self.rss_before / _MB, 1),
+                "rss_after_mb": round(rss_after / _MB, 1),
+                "rss_peak_delta_mb": round((self.peak_rss - self.rss_before) / _MB, 1),
+                "torch_peak_mb": round(torch_peak / _MB, 1) if torch_peak is not None else None,
+                "overlapped": self.overlapped, # Ran alongside other tracked requests; RSS and torch peaks include theirs
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            }
+            self.guard._records.append(record)
+            if self.chars >= _MIN_LEARNING_CHARS:
+                self.guard._bytes_per_char.append((self.peak_rss - self.rss_before) / self.chars)
+        return False
+
+
+class MemoryGuard:
+    def __init__(self, ceiling_mb: float = MEMORY_CEILING_MB, over_ceiling: str = MEMORY_OVER_CEILING,
+                 recycle_after_requests: int = RECYCLE_AFTER_REQUESTS, recycle_rss_mb: float = RECYCLE_RSS_MB,
+                 history: int = 200):
+        self.ceiling_mb = ceiling_mb
+        self.over_ceiling = over_ceiling
+        self.recycle_after_requests = recycle_after_requests
+        self.recycle_rss_mb = recycle_rss_mb
+        self.draining = False
+        self._records = deque(maxlen=history)
+        self._bytes_per_char = deque(maxlen=history)
+        self._active = set()
+        self._in_flight = 0
+        self._requests = 0
+        self._recycle_hooks = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._sampler = None
+
+    # --- accounting ---
+
+    def _sample(self):
+        while True:
+            time.sleep(MEMORY_SAMPLE_INTERVAL)
+            if not self._active:
+                continue
+            rss = current_rss_bytes()
+            with self._lock:
+                for tracking in self._active:
+                    if rss > tracking.peak_rss:
+                        tracking.peak_rss = rss
+
+    def track(self, label: str, chars: int = 0):
+        if self._sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+                    self._sampler.start()
+        return _Tracking(self, label, chars)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rss_mb": round(current_rss_bytes() / _MB, 1),
+                "requests": self._requests,
+                "in_flight": self._in_flight,
+                "draining": self.draining,
+                "ceiling_mb": self.ceiling_mb or None,
+                "estimated_bytes_per_char": round(self._estimated_bytes_per_char(), 1),
+                "recent": list(self._records)[-20:],
+            }
+
+    # --- ceiling ---
+
+    def _estimated_bytes_per_char(self) -> float:
+        # Conservative: the 90th percentile of what recent requests actually cost per input character
+        samples = sorted(value for value in self._bytes_per_char if value > 0)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+
+    def admit(self, text: str) -> str:
+        # Returns the text to process (possibly truncated) or raises MemoryBudgetExceeded
+        if not self.ceiling_mb:
+            return text
+        with self._lock:
+            bytes_per_char = self._estimated_bytes_per_char()
+        if not bytes_per_char:
+            return text # Nothing learned yet
+
+        budget = self.ceiling_mb * _MB - current_rss_bytes()
+        projected = bytes_per_char * len(text)
+        if projected <= budget:
+            return text
+
+        allowed_chars = int(budget / bytes_per_char) if budget > 0 else 0
+        if self.over_ceiling == "downgrade" and allowed_chars >= MEMORY_MIN_INPUT_CHARS:
+            print(f"Memory guard: truncating input from {len(text)} to {allowed_chars} characters "
+                  f"(projected {projected / _MB:.0f} MB over a {budget / _MB:.0f} MB budget)")
+            return text[:allowed_chars]
+        raise MemoryBudgetExceeded(
+            f"Input of {len(text)} characters would need about {projected / _MB:.0f} MB, "
+            f"but only {max(budget, 0) / _MB:.0f} MB is left under the {self.ceiling_mb:.0f} MB ceiling."
+        )
+
+    # --- recycling ---
+
+    def on_recycle(self, hook):
+        # Hooks run right before the process restarts (flush caches, stop child pools, ...)
+        self._recycle_hooks.append(hook)
+
+    def should_recycle(self) -> bool:
+        if self.recycle_after_requests and self._requests >= self.recycle_after_requests:
+            return True
+        if self.recycle_rss_mb and current_rss_bytes() >= self.recycle_rss_mb * _MB:
+            return True
+        return False
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._idle:
+            self._in_flight -= 1
+            self._idle.notify_all()
+
+    def wait_until_idle(self, timeout: float = RECYCLE_DRAIN_TIMEOUT) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def recycle(self):
+        print(f"Memory guard: recycling process {os.getpid()} after {self._requests} requests "
+              f"at {current_rss_bytes() / _MB:.0f} MB RSS")
+        for hook in self._recycle_hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"Memory guard: recycle hook failed: {e}")
+        sys.stdout.flush()
+        if RECYCLE_ACTION == "signal":
+            os.kill(os.getpid(), signal.SIGTERM)
+        else:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def begin_drain(self):
+        with self._lock:
+            if self.draining:
+                return
+            self.draining = True
+        print("Memory guard: draining in-flight requests before recycling")
+
+        def drain_and_recycle():
+            if not self.wait_until_idle():
+                print(f"Memory guard: requests still in flight after {RECYCLE_DRAIN_TIMEOUT:.0f}s, recycling anyway")
+            self.recycle()
+
+        threading.Thread(target=drain_and_recycle, name="memory-recycle", daemon=True).start()
+
+
+class RecyclingMiddleware:
+    # WSGI middleware: turns requests away with 503 while draining, counts HTTP requests as in flight until
+    # their response has been fully sent, and starts the drain once the guard asks for a recycle.
+    def __init__(self, wsgi_app, guard: MemoryGuard, skip_prefixes=("/admin",)):
+        self.wsgi_app = wsgi_app
+        self.guard = guard
+        self.skip_prefixes = skip_prefixes
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "/").startswith(self.skip_prefixes):
+            return self.wsgi_app(environ, start_response)
+        if self.guard.draining:
+            start_response("503 Service Unavailable", [("Content-Type", "text/plain"), ("Retry-After", "5")])
+            return [b"Worker is restarting, please retry shortly.\n"]
+
+        self.guard.request_started()
+
+        def finished():
+            self.guard.request_finished()
+            if self.guard.should_recycle():
+                self.guard.begin_drain()
+
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), [finished])
+        except Exception:
+            finished()
+            raise
+
+
+memory_guard = MemoryGuard()
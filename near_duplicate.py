@@ -0,0 +1,156 @@
+# near_duplicate.py
+#
+# MinHash/LSH index used to spot near-duplicate documents (same review with different whitespace,
+# punctuation or a templated name) so their stored analysis can be reused instead of running the
+# sentiment and summarization models again.
+#
+# Text is normalized (lowercase, punctuation stripped, whitespace collapsed), split into word shingles,
+# and summarized by a MinHash signature. Signatures are split into LSH bands; documents sharing any band
+# are candidates, and a candidate is accepted when the estimated Jaccard similarity reaches the threshold.
+# The index is bounded (least recently used entries are evicted) and can be saved to / loaded from disk.
+
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", 0.8)) # Minimum estimated Jaccard similarity to reuse an analysis
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", 10000))
+NEAR_DUP_INDEX_PATH = os.getenv("NEAR_DUP_INDEX_PATH") # e.g. /app/data/near_duplicates.npz; unset = in-memory only
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def _choose_bands(num_perm: int, threshold: float) -> tuple:
+    # Pick the (bands, rows) split whose LSH S-curve midpoint (1/b)^(1/r) sits closest to the threshold,
+    # preferring to sit just below it so borderline matches still become candidates.
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        midpoint = (1 / bands) ** (1 / rows)
+        distance = abs(threshold - midpoint) + (0.05 if midpoint > threshold else 0.0)
+        if best is None or distance < best[0]:
+            best = (distance, bands, rows)
+    return best[1], best[2] # type: ignore [reportOptionalSubscript]
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD, max_entries: int = NEAR_DUP_MAX_ENTRIES,
+                 num_perm: int = 128, shingle_size: int = 3, seed: int = 1):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.bands, self.rows = _choose_bands(num_perm, threshold)
+
+        # Fixed seed so signatures stay comparable across restarts (required for persistence)
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        self._entries = OrderedDict() # entry id -> (signature, analysis), least recently used first
+        self._buckets = [dict() for _ in range(self.bands)] # per band: band bytes -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def signature(self, text: str) -> np.ndarray:
+        tokens = normalize_text(text).split()
+        if len(tokens) <= self.shingle_size:
+            shingles = {" ".join(tokens)}
+        else:
+            shingles = {" ".join(tokens[i:i + self.shingle_size]) for i in range(len(tokens) - self.shingle_size + 1)}
+        # crc32 rather than hash(): Python's string hash is randomized per process
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def lookup(self, text: str):
+        # Returns (analysis, estimated_similarity) for the most similar stored document, or None
+        signature = self.signature(text)
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(self._band_keys(signature)):
+                candidates.update(self._buckets[band].get(key, ()))
+
+            best_id, best_similarity = None, 0.0
+            for entry_id in candidates:
+                similarity = float(np.mean(self._entries[entry_id][0] == signature))
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or best_similarity < self.threshold:
+                return None
+            self._entries.move_to_end(best_id)
+            return dict(self._entries[best_id][1]), best_similarity
+
+    def add(self, text: str, analysis: dict):
+        self._insert(self.signature(text), analysis)
+
+    def _insert(self, signature: np.ndarray, analysis: dict):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (signature, dict(analysis))
+            for band, key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        entry_id, (signature, _) = self._entries.popitem(last=False)
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def save(self, path: str):
+        with self._lock:
+            entries = list(self._entries.values())
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        signatures = np.stack([signature for signature, _ in entries]) if entries else np.zeros((0, self.num_perm), dtype=np.uint64)
+        # Write to a temp file and rename so a crash mid-save never leaves a truncated index behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                signatures=signatures,
+                analyses=np.array(json.dumps([analysis for _, analysis in entries])),
+                params=np.array(json.dumps({"num_perm": self.num_perm, "shingle_size": self.shingle_size, "seed": self.seed})),
+            )
+        os.replace(tmp_path, path)
+        print(f"Saved near-duplicate index ({len(entries)} entries) to {path}")
+
+    def load(self, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            params = json.loads(str(data["params"]))
+            if params != {"num_perm": self.num_perm, "shingle_size": self.shingle_size, "seed": self.seed}:
+                print(f"Ignoring near-duplicate index at {path}: built with different parameters {params}")
+                return
+            analyses = json.loads(str(data["analyses"]))
+            # Entries were saved least recently used first, so re-inserting keeps the eviction order
+            for signature, analysis in zip(data["signatures"], analyses):
+                self._insert(signature, analysis)
+        print(f"Loaded near-duplicate index ({len(self)} entries) from {path}")
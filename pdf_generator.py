@@ -1,16 +1,37 @@
 # pdf_generator.py
 
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.platypus.tableofcontents import TableOfContents
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from datetime import datetime
+from xml.sax.saxutils import escape
 import os
 
+class _CombinedReportTemplate(SimpleDocTemplate):
+    # Registers every per-document heading with the table of contents as it is laid out
+    def afterFlowable(self, flowable):
+        if isinstance(flowable, Paragraph) and flowable.style.name == "TOCDocumentHeading":
+            self.notify("TOCEntry", (0, escape(flowable.getPlainText()), self.page)) # TOC re-parses entries as markup
+
 class PDFGenerator:
+    # Stylesheet shared by every instance in this process; building it is a noticeable part of small reports
+    _compiled_styles = None
+
+    @classmethod
+    def compiled_styles(cls):
+        if cls._compiled_styles is None:
+            styles = getSampleStyleSheet()
+            styles.add(ParagraphStyle(name="TOCDocumentHeading", parent=styles["h1"]))
+            styles.add(ParagraphStyle(name="TOCLevel0", parent=styles["BodyText"], leftIndent=20, firstLineIndent=-20))
+            cls._compiled_styles = styles
+        return cls._compiled_styles
+
     # __init__ no longer takes filename directly; it's handled in build
     def __init__(self):
-        self.styles = getSampleStyleSheet()
+        self.styles = self.compiled_styles()
         self.story = []
+        self.last_page_count = 0
 
     def add_title(self, title):
         self.story.append(Paragraph(title, self.styles["Title"]))
@@ -29,34 +50,26 @@ class PDFGenerator:
         self.story.append(Paragraph(text, self.styles["BodyText"]))
         self.story.append(Spacer(1, 12))
 
-    # build method now explicitly returns the generated file path
-    def build(self, original_text: str, analysis_result: dict, output_dir: str = "reports") -> str:
-        # Clear story for each new report generated by this instance
-        self.story = [] 
-
+    def _report_path(self, name_part: str, output_dir: str) -> str:
         os.makedirs(output_dir, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Microseconds keep names unique when several renderers write the same snippet in the same second
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         # Sanitize filename part from original text, limiting to 50 chars for practical filenames
-        safe_filename_part = original_text[:50].replace(" ", "_").replace(".", "").replace(",", "").replace("/", "").replace("\\", "").replace(":", "") 
-        pdf_filename_full_path = os.path.join(output_dir, f"report_{safe_filename_part}_{timestamp}.pdf")
-        
-        # Initialize SimpleDocTemplate here, just before building
-        doc = SimpleDocTemplate(pdf_filename_full_path, pagesize=letter) 
-
-        self.add_title("Document Analysis Report")
-        self.add_paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        self.story.append(Spacer(1, 24))
+        safe_filename_part = name_part[:50].replace(" ", "_").replace(".", "").replace(",", "").replace("/", "").replace("\\", "").replace(":", "") 
+        return os.path.join(output_dir, f"report_{safe_filename_part}_{timestamp}.pdf")
 
+    def _add_analysis(self, original_text: str, analysis_result: dict):
         self.add_heading("Original Document Snippet:", level=2)
         # Displaying a snippet of the original text, or full text if short
         display_text = original_text if len(original_text) < 500 else original_text[:500] + "..."
+        # Paragraph parses its text as markup, so document and model text must be escaped
+        display_text = escape(display_text)
         self.add_paragraph(f"\" {display_text} \"")
         self.story.append(Spacer(1, 18))
 
         self.add_heading("Analysis Results:", level=2)
         
-        sentiment_label = analysis_result['sentiment']
+        sentiment_label = escape(str(analysis_result['sentiment']))
         if sentiment_label == 'POSITIVE':
             sentiment_display = f"<font color='green'><b>{sentiment_label}</b></font>"
         elif sentiment_label == 'NEGATIVE':
@@ -65,15 +78,61 @@ class PDFGenerator:
             sentiment_display = f"<font color='blue'><b>{sentiment_label}</b></font>"
 
         self.add_paragraph(f"• Sentiment: {sentiment_display} (Confidence: {analysis_result['confidence']:.2f})")
-        self.add_paragraph(f"• Summary: {analysis_result['summary']}")
+        self.add_paragraph(f"• Summary: {escape(analysis_result['summary'])}")
         self.story.append(Spacer(1, 24))
 
+    # build method now explicitly returns the generated file path
+    def build(self, original_text: str, analysis_result: dict, output_dir: str = "reports") -> str:
+        # Clear story for each new report generated by this instance
+        self.story = [] 
+
+        pdf_filename_full_path = self._report_path(original_text, output_dir)
+        
+        # Initialize SimpleDocTemplate here, just before building
+        doc = SimpleDocTemplate(pdf_filename_full_path, pagesize=letter) 
+
+        self.add_title("Document Analysis Report")
+        self.add_paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        self.story.append(Spacer(1, 24))
+
+        self._add_analysis(original_text, analysis_result)
+
         print(f"Generating PDF report: {pdf_filename_full_path}")
         doc.build(self.story) # Build using the local 'doc' variable
+        self.last_page_count = doc.page
         print("PDF report generated successfully.")
         
         return pdf_filename_full_path # RETURN THE FULL PATH
 
+    def build_combined(self, items: list, output_dir: str = "reports", title: str = "Combined Document Analysis Report") -> str:
+        # items is a list of (original_text, analysis_result) pairs; every document starts on a new page
+        # and is listed in a table of contents at the front.
+        self.story = []
+
+        pdf_filename_full_path = self._report_path(f"combined_{len(items)}_documents", output_dir)
+        doc = _CombinedReportTemplate(pdf_filename_full_path, pagesize=letter)
+
+        self.add_title(title)
+        self.add_paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} — {len(items)} documents")
+        toc = TableOfContents()
+        toc.levelStyles = [self.styles["TOCLevel0"]]
+        self.story.append(toc)
+
+        for index, (original_text, analysis_result) in enumerate(items, start=1):
+            self.story.append(PageBreak())
+            snippet = escape(original_text[:60])
+            self.story.append(Paragraph(f"Document {index}: {escape(str(analysis_result['sentiment']))} — {snippet}...", self.styles["TOCDocumentHeading"]))
+            self.story.append(Spacer(1, 12))
+            self._add_analysis(original_text, analysis_result)
+
+        print(f"Generating combined PDF report ({len(items)} documents): {pdf_filename_full_path}")
+        # multiBuild lays the story out twice so the table of contents can show final page numbers
+        doc.multiBuild(self.story)
+        self.last_page_count = doc.page
+        print("Combined PDF report generated successfully.")
+
+        return pdf_filename_full_path
+
 if __name__ == "__main__":
     # Example usage for PDFGenerator standalone
     sample_result = {
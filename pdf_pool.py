@@ -0,0 +1,204 @@
+# pdf_pool.py
+#
+# Renders PDF reports in a pool of worker processes so ReportLab layout no longer runs on the request
+# thread and competes with model inference for the GIL. Workers receive plain analysis dicts, compile
+# the report styles once at start-up and reuse a single PDFGenerator for every job.
+#
+# Run directly to measure rendering throughput (pages/sec) for one-file-per-document and combined mode:
+#   python pdf_pool.py --documents 200 --workers 4 --bulk-size 100
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pdf_generator import PDFGenerator
+from profiling import profiler, run_profiled
+
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# fork is cheap and doesn't re-import the caller's __main__ (which in app.py would load the models again),
+# but it must happen before the parent runs any torch ops: create the pool and call warm() first.
+PDF_POOL_START_METHOD = os.getenv("PDF_POOL_START_METHOD", "fork" if os.name == "posix" else "spawn")
+
+# Per-process generator, created by the pool initializer
+_worker_generator = None
+
+
+def _init_worker():
+    global _worker_generator
+    PDFGenerator.compiled_styles()
+    _worker_generator = PDFGenerator()
+
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+
+def _generator() -> PDFGenerator:
+    # Also lets the render functions run in-process (e.g. when the pool is disabled)
+    global _worker_generator
+    if _worker_generator is None:
+        _init_worker()
+    return _worker_generator # type: ignore [reportReturnType]
+
+
+def _render_report(original_text: str, analysis_result: dict, output_dir: str) -> dict:
+    start = time.perf_counter()
+    generator = _generator()
+    path = generator.build(original_text=original_text, analysis_result=analysis_result, output_dir=output_dir)
+    return {"path": path, "pages": generator.last_page_count, "render_ms": (time.perf_counter() - start) * 1000}
+
+
+def _render_combined(items: list, output_dir: str, title: str) -> dict:
+    start = time.perf_counter()
+    generator = _generator()
+    path = generator.build_combined(items, output_dir=output_dir, title=title)
+    return {"path": path, "pages": generator.last_page_count, "render_ms": (time.perf_counter() - start) * 1000}
+
+
+class PDFRenderPool:
+    def __init__(self, max_workers: int = PDF_POOL_WORKERS, start_method: str = PDF_POOL_START_METHOD):
+        self.max_workers = max_workers
+        self.start_method = start_method
+        # Set to False once the parent has run torch ops (e.g. loaded the models): forking after that can
+        # deadlock the child, so a dead worker is then replaced by in-process rendering instead of a new pool
+        self.fork_safe = True
+        self.on_degraded = None # Called after switching to in-process rendering (app.py recycles the process)
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker,
+        )
+
+    def _replace_broken(self, broken_executor):
+        # A worker that dies (e.g. OOM on a huge combined report) breaks the executor for good
+        with self._lock:
+            if self._executor is not broken_executor:
+                return # Another thread already replaced it
+            broken_executor.shutdown(wait=False)
+            if self.start_method == "fork" and not self.fork_safe:
+                print("PDF render pool: a worker died; rendering in-process from now on.")
+                self._executor = None
+                if self.on_degraded is not None:
+                    self.on_degraded()
+            else:
+                print("PDF render pool: a worker died; starting a new pool.")
+                self._executor = self._new_executor()
+
+    def _submit(self, fn, *args):
+        executor = self._executor
+        if executor is not None:
+            try:
+                return executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._replace_broken(executor)
+                return self._submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _call(self, fn, *args) -> dict:
+        capture = profiler.current_capture()
+        if capture is None or self._executor is None:
+            # In-process rendering is already seen by the calling thread's profile
+            return self._submit(fn, *args).result()
+        # Profile the render in the worker too; otherwise the capture only shows this thread waiting
+        result, stats = self._submit(run_profiled, fn, *args).result()
+        capture.add_stats(stats)
+        return result
+
+    def _run(self, fn, *args) -> dict:
+        executor = self._executor
+        try:
+            return self._call(fn, *args)
+        except BrokenProcessPool:
+            # Retry once on a fresh pool (or in-process)
+            self._replace_broken(executor)
+            return self._call(fn, *args)
+
+    def warm(self):
+        # Starts every worker process now (running the initializer) instead of on the first report
+        for future in [self._submit(_worker_ready) for _ in range(self.max_workers)]:
+            future.result()
+
+    def submit(self, original_text: str, analysis_result: dict, output_dir: str = "reports"):
+        # Returns a Future resolving to {"path", "pages", "render_ms"}
+        return self._submit(_render_report, original_text, analysis_result, output_dir)
+
+    def render(self, original_text: str, analysis_result: dict, output_dir: str = "reports") -> str:
+        return self._run(_render_report, original_text, analysis_result, output_dir)["path"]
+
+    def submit_combined(self, items: list, output_dir: str = "reports", title: str = "Combined Document Analysis Report"):
+        # items: list of (original_text, analysis_result) pairs rendered into one PDF with a table of contents
+        return self._submit(_render_combined, list(items), output_dir, title)
+
+    def render_combined(self, items: list, output_dir: str = "reports", title: str = "Combined Document Analysis Report") -> str:
+        return self._run(_render_combined, list(items), output_dir, title)["path"]
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+def benchmark(pool: PDFRenderPool, documents: int, bulk_size: int, output_dir: str) -> dict:
+    sample_texts = []
+    for sample_file in ("product1.txt", "product2.txt"):
+        if os.path.exists(sample_file):
+            with open(sample_file, "r", encoding="utf-8") as f:
+                sample_texts.append(f.read().strip())
+    if not sample_texts:
+        sample_texts = ["The product was amazing and exceeded expectations. The delivery was fast, and customer service was responsive."]
+
+    items = []
+    for i in range(documents):
+        items.append((
+            sample_texts[i % len(sample_texts)],
+            {"sentiment": ("POSITIVE", "NEGATIVE", "NEUTRAL")[i % 3], "confidence": 0.9, "summary": sample_texts[i % len(sample_texts)][:200]},
+        ))
+
+    # Process start-up and style compilation aren't part of the measurement
+    pool.warm()
+
+    start = time.perf_counter()
+    single_results = [f.result() for f in [pool.submit(text, result, output_dir) for text, result in items]]
+    single_seconds = time.perf_counter() - start
+    single_pages = sum(r["pages"] for r in single_results)
+
+    start = time.perf_counter()
+    chunks = [items[i:i + bulk_size] for i in range(0, len(items), bulk_size)]
+    bulk_results = [f.result() for f in [pool.submit_combined(chunk, output_dir) for chunk in chunks]]
+    bulk_seconds = time.perf_counter() - start
+    bulk_pages = sum(r["pages"] for r in bulk_results)
+
+    return {
+        "single": {"files": len(single_results), "pages": single_pages, "seconds": single_seconds, "pages_per_sec": single_pages / single_seconds},
+        "bulk": {"files": len(bulk_results), "pages": bulk_pages, "seconds": bulk_seconds, "pages_per_sec": bulk_pages / bulk_seconds},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure PDF rendering throughput of the render pool.")
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=PDF_POOL_WORKERS)
+    parser.add_argument("--bulk-size", type=int, default=50, help="Documents per combined PDF in bulk mode")
+    parser.add_argument("--output-dir", default="benchmark_reports")
+    args = parser.parse_args()
+
+    render_pool = PDFRenderPool(max_workers=args.workers)
+    try:
+        results = benchmark(render_pool, args.documents, args.bulk_size, args.output_dir)
+    finally:
+        render_pool.shutdown()
+
+    for mode, stats in results.items():
+        print(f"{mode:>6}: {stats['files']} files, {stats['pages']} pages in {stats['seconds']:.2f}s -> {stats['pages_per_sec']:.1f} pages/sec")
@@ -0,0 +1,374 @@
+# pipeline_engine.py
+#
+# Staged pipeline so the different kinds of work in report generation overlap across documents:
+# while document N is being rendered (GIL-bound ReportLab) or emailed (network-bound SMTP), document N+1
+# is already in the classifier and N+2 in the summarizer. Each stage has its own bounded input queue and
+# executor; when a stage falls behind its queue fills up and upstream stages block (backpressure), so
+# memory stays bounded no matter how fast documents are submitted.
+#
+# Executors per stage:
+#   "thread"  - N worker threads calling fn(state); for model inference (torch releases the GIL) and blocking I/O
+#   "process" - N worker threads feeding a ProcessPoolExecutor; fn must be a picklable top-level function
+#   "async"   - coroutine fn(state) run on a dedicated event loop, at most N in flight
+#
+# Usage (standalone demo over local files):
+#   python pipeline_engine.py product1.txt product2.txt --email someone@example.com
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from memory_guard import memory_guard
+from profiling import profiler, run_profiled
+
+# Utilization is measured over this many recent seconds, so it shows whether a stage is saturated now
+PIPELINE_UTILIZATION_WINDOW = float(os.getenv("PIPELINE_UTILIZATION_WINDOW", 60))
+
+_STOP = object()
+
+
+class _Job:
+    __slots__ = ("state", "future", "capture")
+
+    def __init__(self, state: dict, capture=None):
+        self.state = state
+        self.future = Future()
+        self.capture = capture # Profiler capture of the submitting request, followed into the stage threads
+
+
+class Stage:
+    def __init__(self, name: str, fn, kind: str = "thread", workers: int = 1, queue_size: int = 8,
+                 initializer=None, start_method: str = "spawn"):
+        if kind not in ("thread", "process", "async"):
+            raise ValueError(f"Unknown executor kind '{kind}' for stage '{name}'")
+        self.name = name
+        self.fn = fn
+        self.kind = kind
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self._initializer = initializer
+        self._start_method = start_method
+        self._threads = []
+        self._process_pool = None
+        self._loop = None
+        self._async_slots = threading.BoundedSemaphore(workers)
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+        self._started_at = None
+        self._recent = deque() # (start, end) of jobs that finished within the utilization window
+        self._running = [] # Start times of jobs in flight
+
+    # --- lifecycle ---
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        if self.kind == "process":
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self._start_method),
+                initializer=self._initializer,
+            )
+        if self.kind == "async":
+            self._loop = asyncio.new_event_loop()
+            self._threads.append(threading.Thread(target=self._loop.run_forever, name=f"{self.name}-loop", daemon=True))
+            self._threads.append(threading.Thread(target=self._feed_async, name=f"{self.name}-feeder", daemon=True))
+        else:
+            for i in range(self.workers):
+                self._threads.append(threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # Called after every upstream stage has stopped, so the sentinels queue up behind real work
+        consumers = 1 if self.kind == "async" else self.workers
+        for _ in range(consumers):
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            if thread.name.endswith("-loop"):
+                continue
+            thread.join()
+        if self.kind == "async":
+            # Let in-flight coroutines finish before stopping the loop
+            for _ in range(self.workers):
+                self._async_slots.acquire()
+            self._loop.call_soon_threadsafe(self._loop.stop) # type: ignore [reportOptionalMemberAccess]
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+
+    # --- execution ---
+
+    def _begin(self):
+        started = time.perf_counter()
+        with self._lock:
+            self._in_flight += 1
+            self._running.append(started)
+        return started
+
+    def _finish(self, job: _Job, started: float, result=None, error=None):
+        finished = time.perf_counter()
+        with self._lock:
+            self._in_flight -= 1
+            self._busy_seconds += finished - started
+            self._running.remove(started)
+            self._recent.append((started, finished))
+            if error is None:
+                self._processed += 1
+            else:
+                self._failed += 1
+        if error is not None:
+            job.future.set_exception(error)
+        elif self.next_stage is None:
+            job.future.set_result(result)
+        else:
+            job.state = result
+            # Blocks while the next stage's queue is full: this is the backpressure
+            self.next_stage.queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                return
+            started = self._begin()
+            try:
+                if self.kind == "process" and job.capture is not None:
+                    result, stats = self._process_pool.submit(run_profiled, self.fn, job.state).result() # type: ignore [reportOptionalMemberAccess]
+                    job.capture.add_stats(stats)
+                elif self.kind == "process":
+                    result = self._process_pool.submit(self.fn, job.state).result() # type: ignore [reportOptionalMemberAccess]
+                else:
+                    with profiler.attach(job.capture):
+                        result = self.fn(job.state)
+            except Exception as e:
+                self._finish(job, started, error=e)
+            else:
+                self._finish(job, started, result=result)
+
+    def _feed_async(self):
+        while True:
+            # Take a slot before taking work, so at most `workers` coroutines are in flight
+            self._async_slots.acquire()
+            job = self.queue.get()
+            if job is _STOP:
+                self._async_slots.release()
+                return
+            asyncio.run_coroutine_threadsafe(self._run_async(job), self._loop) # type: ignore [reportArgumentType]
+
+    async def _run_async(self, job: _Job):
+        started = self._begin()
+        try:
+            result = await self.fn(job.state)
+        except Exception as e:
+            error, result = e, None
+        else:
+            error = None
+        # _finish may block on a full downstream queue, which must not stall the event loop
+        await asyncio.get_running_loop().run_in_executor(None, lambda: self._finish(job, started, result=result, error=error))
+        self._async_slots.release()
+
+    def _window_busy_seconds(self, now: float, window_start: float) -> float:
+        # Busy time inside [window_start, now], counting jobs still running; call with the lock held
+        while self._recent and self._recent[0][1] <= window_start:
+            self._recent.popleft()
+        busy = sum(end - max(start, window_start) for start, end in self._recent)
+        return busy + sum(now - max(start, window_start) for start in self._running)
+
+    def stats(self) -> dict:
+        now = time.perf_counter()
+        window = min(PIPELINE_UTILIZATION_WINDOW, now - self._started_at) if self._started_at else 0.0
+        with self._lock:
+            completed = self._processed + self._failed
+            window_busy = self._window_busy_seconds(now, now - window)
+            return {
+                "executor": self.kind,
+                "workers": self.workers,
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "in_flight": self._in_flight,
+                "processed": self._processed,
+                "failed": self._failed,
+                "avg_ms": (self._busy_seconds / completed * 1000) if completed else 0.0,
+                # Share of the stage's worker capacity spent busy over the last utilization_window_s seconds
+                "utilization": (window_busy / (window * self.workers)) if window else 0.0,
+                "utilization_window_s": round(window, 1),
+            }
+
+
+class Pipeline:
+    def __init__(self, stages: list):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self._started = False
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self._started = True
+        return self
+
+    def submit(self, state: dict) -> Future:
+        # Blocks while the first stage's queue is full
+        if not self._started:
+            raise RuntimeError("Pipeline.start() must be called before submit().")
+        job = _Job(state, profiler.current_capture())
+        self.stages[0].queue.put(job)
+        return job.future
+
+    def map(self, states: list) -> list:
+        # Submits everything (subject to backpressure) and returns results in input order;
+        # a failed document yields its exception instead of a result.
+        futures = [self.submit(state) for state in states]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self) -> dict:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def shutdown(self):
+        # Drain stage by stage so nothing submitted before shutdown is lost
+        for stage in self.stages:
+            stage.stop()
+        self._started = False
+
+
+# --- Report generation pipeline ---
+
+DEFAULT_EMAIL_BODY = (
+    "Dear client,\n\n"
+    "Please find your AI document analysis report attached. "
+    "The report provides sentiment analysis and a summary of your uploaded document.\n\n"
+    "Best regards,\n"
+    "Your AI Analysis Service"
+)
+
+
+def _render_in_worker(state: dict) -> dict:
+    # Runs inside a render process (see pdf_pool._init_worker)
+    from pdf_pool import _render_report
+    analysis_result = {k: state[k] for k in ("sentiment", "confidence", "summary")}
+    rendered = _render_report(state["text"], analysis_result, state["output_dir"])
+    return dict(state, report_path=rendered["path"])
+
+
+def build_report_pipeline(agent, email_service=None, pdf_pool=None, output_dir: str = "reports",
+                          queue_size: int = 8, render_workers: int = 2, delivery_workers: int = 4) -> Pipeline:
+    # Input state: {"data": bytes or str, "to_email": optional, "subject": optional}
+    # Output state adds "text", "analyzed_text", "sentiment", "confidence", "summary", "reused", "truncated",
+    # "analyzed_chars", "report_path" and "emailed" (plus "email_error" when delivery failed).
+    # "analyzed_text" is what the models see: "text" cut short if the memory guard downgraded the document.
+
+    def decode(state: dict) -> dict:
+        data = state["data"]
+        text = data.decode("utf-8") if isinstance(data, bytes) else data
+        state = dict(state, output_dir=state.get("output_dir", output_dir))
+        # A near-duplicate hit skips both model stages, like DocumentAgent.analyze_document
+        reused_result = agent._reuse_near_duplicate(text)
+        if reused_result is not None:
+            return dict(state, text=text, analyzed_text=text, **agent._note_truncation(reused_result, text, text))
+        analyzed_text = memory_guard.admit(text)
+        return dict(state, text=text, analyzed_text=analyzed_text, reused=False,
+                    truncated=len(analyzed_text) < len(text), analyzed_chars=len(analyzed_text))
+
+    def classify(state: dict) -> dict:
+        if state["reused"]:
+            return state
+        return dict(state, **agent.classify(state["analyzed_text"]))
+
+    def summarize(state: dict) -> dict:
+        if state["reused"]:
+            return state
+        # Generation dominates a document's memory footprint, so that's what gets accounted
+        with memory_guard.track("pipeline_summarize", len(state["analyzed_text"])):
+            summary = agent.summarize(state["analyzed_text"])
+        if not state["truncated"]:
+            agent._remember_analysis(state["text"], {"sentiment": state["sentiment"], "confidence": state["confidence"], "summary": summary})
+        return dict(state, summary=summary)
+
+    def render_with_pool(state: dict) -> dict:
+        analysis_result = {k: state[k] for k in ("sentiment", "confidence", "summary")}
+        return dict(state, report_path=pdf_pool.render(state["text"], analysis_result, state["output_dir"])) # type: ignore [reportOptionalMemberAccess]
+
+    def deliver(state: dict) -> dict:
+        if not state.get("to_email") or email_service is None:
+            return dict(state, emailed=False)
+        try:
+            email_service.send_email(
+                to_email=state["to_email"],
+                subject=state.get("subject") or "Your Document Analysis Report",
+                body=DEFAULT_EMAIL_BODY,
+                attachment_path=state["report_path"],
+            )
+        except Exception as e:
+            # Like the upload form, a failed email doesn't lose the report that was already rendered
+            print(f"Error sending email to {state['to_email']}: {e}")
+            return dict(state, emailed=False, email_error=str(e))
+        return dict(state, emailed=True)
+
+    if pdf_pool is not None:
+        # Reuse the app's render processes; these threads only wait on them
+        render_stage = Stage("render", render_with_pool, kind="thread", workers=pdf_pool.max_workers, queue_size=queue_size)
+    else:
+        from pdf_pool import _init_worker
+        render_stage = Stage("render", _render_in_worker, kind="process", workers=render_workers, queue_size=queue_size, initializer=_init_worker)
+
+    return Pipeline([
+        Stage("decode", decode, kind="thread", workers=1, queue_size=queue_size),
+        # One worker each: the models are shared and torch already spreads each op over its intra-op threads.
+        # That thread pool is process-wide, so these stages and the request threads serving /api/analyze
+        # oversubscribe the CPU when they run ops at the same time: each op slows down, but the cores stay
+        # busy. Cap the pool with TORCH_NUM_THREADS (see document_agent.py) if latency matters more.
+        Stage("classify", classify, kind="thread", workers=1, queue_size=queue_size),
+        Stage("summarize", summarize, kind="thread", workers=1, queue_size=queue_size),
+        render_stage,
+        Stage("deliver", deliver, kind="thread", workers=delivery_workers, queue_size=queue_size),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate reports for several documents through the staged pipeline.")
+    parser.add_argument("files", nargs="+", help="Text files to analyze")
+    parser.add_argument("--email", default=None, help="Send every report to this address")
+    parser.add_argument("--output-dir", default="local_analysis_reports")
+    args = parser.parse_args()
+
+    from document_agent import DocumentAgent
+    from email_service import EmailService
+
+    report_pipeline = build_report_pipeline(DocumentAgent(), EmailService(), output_dir=args.output_dir).start()
+    documents = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            documents.append({"data": f.read(), "to_email": args.email})
+
+    start = time.perf_counter()
+    results = report_pipeline.map(documents)
+    elapsed = time.perf_counter() - start
+    report_pipeline.shutdown()
+
+    for path, result in zip(args.files, results):
+        if isinstance(result, Exception):
+            print(f"{path}: FAILED ({result})")
+        else:
+            print(f"{path}: {result['sentiment']} -> {result['report_path']} (emailed: {result['emailed']})")
+    print(f"\n{len(documents)} documents in {elapsed:.2f}s")
+    for name, stats in report_pipeline.stats().items():
+        print(f"  {name:<10} {stats['executor']:<8} processed={stats['processed']} failed={stats['failed']} avg={stats['avg_ms']:.0f}ms utilization={stats['utilization']:.0%}")
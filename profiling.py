@@ -0,0 +1,246 @@
+# profiling.py
+#
+# On-demand profiling of live requests. Arm the profiler for the next N requests or the next T seconds
+# (via the /admin/profile endpoint or app.py --profile-requests/--profile-seconds) and each captured
+# request writes:
+#   <PROFILE_DIR>/<timestamp>_<label>_<n>.trace.json  torch.profiler operator trace (open in chrome://tracing or Perfetto)
+#   <PROFILE_DIR>/<timestamp>_<label>_<n>.pstats      cProfile stats (python -m pstats, snakeviz)
+#
+# When the profiler is not armed, capture() and section() only check a boolean and return a shared
+# no-op context manager, so normal requests pay nothing.
+#
+# Work the request hands off is folded into its .pstats: PDF rendering in pdf_pool worker processes (via
+# run_profiled) and pipeline stage threads (via attach()). Not covered: async pipeline stages, work on the
+# asyncio stream server, and torch operator traces outside the request thread's process-wide torch profiler.
+
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from werkzeug.wsgi import ClosingIterator
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", 2))
+
+_NO_OP = nullcontext()
+
+
+def run_profiled(fn, *args):
+    # Runs fn under cProfile (typically in a worker process) and returns (result, raw stats) so the caller
+    # can fold the stats into its request's capture with _Capture.add_stats
+    profile = cProfile.Profile()
+    result = profile.runcall(fn, *args)
+    profile.create_stats()
+    return result, profile.stats # type: ignore [reportAttributeAccessIssue]
+
+
+class _Capture:
+    def __init__(self, profiler, label: str):
+        self.profiler = profiler
+        self.label = label
+        self.torch_profile = None
+        self.python_profile = None
+        self.extra_stats = [] # Raw cProfile stats from worker processes and stage threads
+        self.closed = False
+
+    def add_stats(self, stats: dict):
+        with self.profiler._lock:
+            if not self.closed:
+                self.extra_stats.append(stats)
+
+    def __enter__(self):
+        # torch.profiler is process-global, so only one capture at a time can record operator traces
+        if self.profiler._torch_lock.acquire(blocking=False):
+            try:
+                import torch.profiler
+                self.torch_profile = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU],
+                    record_shapes=True,
+                    with_stack=False,
+                )
+                self.torch_profile.__enter__()
+            except Exception as e:
+                print(f"Profiler: torch trace unavailable for {self.label}: {e}")
+                self.torch_profile = None
+                self.profiler._torch_lock.release()
+
+        self.python_profile = cProfile.Profile()
+        try:
+            self.python_profile.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active cProfile per interpreter
+            self.python_profile = None
+
+        with self.profiler._lock:
+            self.profiler._active_captures += 1
+        self.profiler._local.active = True
+        self.profiler._local.capture = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._local.active = False
+        self.profiler._local.capture = None
+        with self.profiler._lock:
+            self.profiler._active_captures -= 1
+            self.closed = True
+        base_path = self.profiler._next_output_path(self.label)
+        try:
+            # Stop both profilers before writing anything so file I/O isn't recorded
+            if self.python_profile is not None:
+                self.python_profile.disable()
+            if self.torch_profile is not None:
+                self.torch_profile.__exit__(None, None, None)
+            if self.python_profile is not None or self.extra_stats:
+                combined = pstats.Stats(self.python_profile) if self.python_profile is not None else pstats.Stats()
+                for stats in self.extra_stats:
+                    other = pstats.Stats()
+                    other.stats = stats # type: ignore [reportAttributeAccessIssue]
+                    other.get_top_level_stats() # type: ignore [reportAttributeAccessIssue]
+                    combined.add(other)
+                combined.dump_stats(base_path + ".pstats")
+            if self.torch_profile is not None:
+                self.torch_profile.export_chrome_trace(base_path + ".trace.json")
+            print(f"Profiler: wrote capture for {self.label} to {base_path}.*")
+        except Exception as e:
+            print(f"Profiler: failed to write capture for {self.label}: {e}")
+        finally:
+            if self.torch_profile is not None:
+                self.profiler._torch_lock.release()
+            self.profiler._slots.release()
+        return False
+
+
+class RequestProfiler:
+    def __init__(self, output_dir: str = PROFILE_DIR, max_concurrent: int = PROFILE_MAX_CONCURRENT):
+        self.output_dir = output_dir
+        self.max_concurrent = max_concurrent
+        self.armed = False
+        self._remaining_requests = None
+        self._deadline = None
+        self._captured = 0
+        self._active_captures = 0
+        self._lock = threading.Lock()
+        self._torch_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._local = threading.local()
+
+    def arm(self, requests=None, seconds=None):
+        if not requests and not seconds:
+            raise ValueError("Specify a number of requests and/or a number of seconds to profile.")
+        with self._lock:
+            self._remaining_requests = int(requests) if requests else None
+            self._deadline = time.monotonic() + float(seconds) if seconds else None
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.armed = True
+        print(f"Profiler armed: requests={requests}, seconds={seconds}, output_dir={self.output_dir}")
+
+    def disarm(self):
+        with self._lock:
+            self.armed = False
+            self._remaining_requests = None
+            self._deadline = None
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "armed": self.armed,
+                "remaining_requests": self._remaining_requests,
+                "remaining_seconds": max(0.0, self._deadline - time.monotonic()) if self._deadline else None,
+                "captured": self._captured,
+                "max_concurrent": self.max_concurrent,
+                "output_dir": self.output_dir,
+            }
+
+    def _next_output_path(self, label: str) -> str:
+        with self._lock:
+            self._captured += 1
+            sequence = self._captured
+        safe_label = re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_") or "request"
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        return os.path.join(self.output_dir, f"{timestamp}_{safe_label}_{sequence}")
+
+    def capture(self, label: str):
+        if not self.armed:
+            return _NO_OP
+
+        with self._lock:
+            if not self.armed:
+                return _NO_OP
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                self.armed = False
+                return _NO_OP
+            # Over the concurrency cap: let this request through unprofiled rather than queueing it
+            if not self._slots.acquire(blocking=False):
+                return _NO_OP
+            if self._remaining_requests is not None:
+                self._remaining_requests -= 1
+                if self._remaining_requests <= 0:
+                    self.armed = False
+        return _Capture(self, label)
+
+    def current_capture(self):
+        # The capture of the request this thread is working for, or None
+        return getattr(self._local, "capture", None)
+
+    @contextmanager
+    def attach(self, capture):
+        # Profiles work done on this thread on behalf of another thread's capture (pipeline stage threads).
+        # cProfile only sees the thread it was enabled on, so this thread gets its own profile.
+        if capture is None:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            profile = None # Python 3.12+ allows only one active cProfile per interpreter
+        self._local.active = True
+        self._local.capture = capture
+        try:
+            yield
+        finally:
+            self._local.active = False
+            self._local.capture = None
+            if profile is not None:
+                profile.disable()
+                profile.create_stats()
+                capture.add_stats(profile.stats) # type: ignore [reportAttributeAccessIssue]
+
+    def section(self, name: str):
+        # Named range inside a capture (shows up as a labelled block in the Chrome trace)
+        if not self._active_captures or not getattr(self._local, "active", False):
+            return _NO_OP
+        import torch.profiler
+        return torch.profiler.record_function(name)
+
+
+class ProfilingMiddleware:
+    # WSGI middleware that wraps each request in profiler.capture() while the profiler is armed
+    def __init__(self, wsgi_app, profiler: RequestProfiler, skip_prefixes=("/admin",)):
+        self.wsgi_app = wsgi_app
+        self.profiler = profiler
+        self.skip_prefixes = skip_prefixes
+
+    def __call__(self, environ, start_response):
+        if not self.profiler.armed:
+            return self.wsgi_app(environ, start_response)
+        path = environ.get("PATH_INFO", "/")
+        if path.startswith(self.skip_prefixes):
+            return self.wsgi_app(environ, start_response)
+        capture = self.profiler.capture(f"{environ.get('REQUEST_METHOD', 'GET')} {path}")
+        capture.__enter__()
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException as e:
+            capture.__exit__(type(e), e, e.__traceback__)
+            raise
+        # Keep the capture open until the server closes the response, so work done while streaming is
+        # included without buffering the body (which would break SSE and time-to-first-byte)
+        return ClosingIterator(response, [lambda: capture.__exit__(None, None, None)])
+
+
+profiler = RequestProfiler()
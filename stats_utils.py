@@ -0,0 +1,15 @@
+# stats_utils.py
+#
+# Small statistics helpers shared by the offline tools (evaluate_models.py, load_test.py). Keep this module
+# free of imports with side effects so any script can use it.
+
+import math
+
+
+def percentile(values: list, pct: float) -> float:
+    # Nearest-rank percentile: the smallest value with at least pct% of the values at or below it
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct * len(ordered) / 100))
+    return ordered[min(rank, len(ordered)) - 1]
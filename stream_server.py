@@ -0,0 +1,172 @@
+# stream_server.py
+#
+# Asyncio server for the streaming endpoint: POST /api/stream with the same JSON body and the same events as
+# app.py's Flask route. Flask's threaded server keeps one OS thread per open SSE connection for the whole
+# stream; here every connection is a coroutine on a single event loop awaiting an asyncio.Queue that the
+# shared generation pool feeds, so open streams cost no threads beyond the fixed generation pool.
+#
+# `python app.py` starts it on STREAM_PORT next to the Flask server, sharing the loaded models. Route
+# /api/stream to that port in the reverse proxy, or point streaming clients at it directly and set
+# STREAM_REPORT_BASE_URL to the main app's URL so the report links resolve. JSON bodies only; multipart
+# uploads still go through the Flask route.
+
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import quote
+
+from memory_guard import memory_guard
+
+STREAM_HOST = os.getenv("STREAM_HOST", "0.0.0.0")
+STREAM_PORT = int(os.getenv("STREAM_PORT", 5001)) # 0 disables the asyncio stream server
+STREAM_REPORT_BASE_URL = os.getenv("STREAM_REPORT_BASE_URL", "") # Prefix for report_url; empty keeps it relative
+
+_REASONS = {400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+            413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class StreamServer:
+    def __init__(self, agent, generation_executor, read_text, render_report, max_body_bytes: int,
+                 host: str = STREAM_HOST, port: int = STREAM_PORT):
+        # read_text(body: bytes, content_encoding: str) -> str parses a request body the way the Flask route does
+        # render_report(text, analysis_result) -> str renders the PDF (blocking) and returns its file name
+        self.agent = agent
+        self.generation_executor = generation_executor
+        self.read_text = read_text
+        self.render_report = render_report
+        self.max_body_bytes = max_body_bytes
+        self.host = host
+        self.port = port
+        self._loop = None
+
+    def start(self):
+        # Runs the event loop on one background thread; returns once the port is bound (or raises)
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            except Exception as e:
+                errors.append(e)
+                ready.set()
+                return
+            print(f"Streaming server listening on {self.host}:{self.port}")
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="stream-server", daemon=True).start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    async def _send_json(self, writer, status: int, payload: dict, extra_headers: str = ""):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write((f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\n{extra_headers}Connection: close\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _read_request(self, reader, writer):
+        # Returns the document text, or None after an error response has been sent
+        request_line = (await reader.readline()).decode("latin-1")
+        parts = request_line.split()
+        if len(parts) != 3:
+            await self._send_json(writer, 400, {"error": "Malformed request line."})
+            return None
+        method, path = parts[0], parts[1].split("?", 1)[0]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if path != "/api/stream":
+            await self._send_json(writer, 404, {"error": "Not found."})
+            return None
+        if method != "POST":
+            await self._send_json(writer, 405, {"error": "Method not allowed."}, "Allow: POST\r\n")
+            return None
+        if not headers.get("content-length", "").isdigit():
+            await self._send_json(writer, 411, {"error": "Content-Length is required."})
+            return None
+        length = int(headers["content-length"])
+        if length > self.max_body_bytes:
+            await self._send_json(writer, 413, {"error": f"Request body exceeds {self.max_body_bytes} bytes."})
+            return None
+
+        body = await reader.readexactly(length)
+        try:
+            return self.read_text(body, headers.get("content-encoding", ""))
+        except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            await self._send_json(writer, 400, {"error": f"Malformed request body: {e}"})
+        except ValueError as ve:
+            await self._send_json(writer, 400, {"error": str(ve)})
+        except Exception as e:
+            if getattr(e, "code", None) != 413:
+                raise
+            await self._send_json(writer, 413, {"error": getattr(e, "description", None) or str(e)})
+        return None
+
+    async def _handle(self, reader, writer):
+        # Same drain/recycle bookkeeping as RecyclingMiddleware, so a recycle waits for open streams
+        if memory_guard.draining:
+            await self._send_json(writer, 503, {"error": "Worker is restarting, please retry shortly."}, "Retry-After: 5\r\n")
+            writer.close()
+            return
+        memory_guard.request_started()
+        try:
+            text = await self._read_request(reader, writer)
+            if text is not None:
+                await self._stream(text, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass # Client went away or sent garbage; nothing left to answer
+        finally:
+            writer.close()
+            memory_guard.request_finished()
+            if memory_guard.should_recycle():
+                memory_guard.begin_drain()
+
+    async def _stream(self, text: str, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"X-Accel-Buffering: no\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        events = self.agent.astream_analysis(text, self.generation_executor)
+        try:
+            analysis_result = None
+            async for event, payload in events:
+                if event == "sentiment":
+                    chunk = sse_event("sentiment", payload)
+                elif event == "token":
+                    chunk = sse_event("token", {"text": payload})
+                elif event == "waiting":
+                    chunk = ": waiting for a generation worker\n\n"
+                else:
+                    analysis_result = payload
+                    continue
+                # drain() raises once the client has gone, which closes `events` and cancels the generation
+                writer.write(chunk.encode("utf-8"))
+                await writer.drain()
+
+            report_name = await asyncio.get_running_loop().run_in_executor(None, self.render_report, text, analysis_result)
+            writer.write(sse_event("done", {
+                "analysis": analysis_result,
+                "report_url": f"{STREAM_REPORT_BASE_URL.rstrip('/')}/reports/{quote(report_name)}",
+            }).encode("utf-8"))
+            await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as e:
+            writer.write(sse_event("error", {"error": f"An internal server error occurred during analysis: {str(e)}"}).encode("utf-8"))
+            await writer.drain()
+        finally:
+            await events.aclose()
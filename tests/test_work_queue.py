@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from work_queue import WorkQueue
+from worker import run_worker
+
+VISIBILITY_TIMEOUT = 1.0
+HEARTBEAT_INTERVAL = 0.2
+
+
+class BlockingAgent:
+    # Stands in for DocumentAgent in the worker that gets killed: signals that it holds the job, then hangs
+    def __init__(self, started_path: str):
+        self.started_path = started_path
+
+    def generate_report(self, text: str, output_dir: str = "reports") -> str:
+        with open(self.started_path, "w") as f:
+            f.write(str(os.getpid()))
+        time.sleep(60)
+        return "never"
+
+
+class RecordingAgent:
+    # Stands in for DocumentAgent in the surviving workers: records every report it generates
+    def __init__(self, completions_path: str):
+        self.completions_path = completions_path
+
+    def generate_report(self, text: str, output_dir: str = "reports") -> str:
+        with open(self.completions_path, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        return os.path.join(output_dir, "report.pdf")
+
+
+def _run(queue_path: str, agent, worker_id: str, output_dir: str):
+    run_worker(WorkQueue(queue_path), agent, worker_id=worker_id, output_dir=output_dir,
+               visibility_timeout=VISIBILITY_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL, poll_interval=0.05)
+
+
+def _wait_for(condition, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_job_of_killed_worker_is_completed_exactly_once(tmp_path):
+    context = multiprocessing.get_context("fork")
+    queue_path = str(tmp_path / "queue.sqlite3")
+    started_path = str(tmp_path / "started")
+    completions_path = str(tmp_path / "completions")
+    queue = WorkQueue(queue_path, max_attempts=3)
+    job_id = queue.enqueue({"text": "The product was amazing."})
+
+    victim = context.Process(target=_run, args=(queue_path, BlockingAgent(started_path), "victim", str(tmp_path)))
+    victim.start()
+    assert _wait_for(lambda: os.path.exists(started_path)), "victim never picked up the job"
+    assert queue.get(job_id)["status"] == "leased"
+    os.kill(victim.pid, signal.SIGKILL) # type: ignore [reportArgumentType]
+    victim.join()
+
+    survivors = [
+        context.Process(target=_run, args=(queue_path, RecordingAgent(completions_path), f"survivor-{i}", str(tmp_path)))
+        for i in range(2)
+    ]
+    for survivor in survivors:
+        survivor.start()
+    try:
+        assert _wait_for(lambda: queue.get(job_id)["status"] == "done"), "job was never reclaimed"
+        # Give the other survivor a chance to (wrongly) pick the job up as well
+        time.sleep(VISIBILITY_TIMEOUT * 2)
+    finally:
+        for survivor in survivors:
+            survivor.terminate()
+            survivor.join()
+
+    job = queue.get(job_id)
+    assert job["status"] == "done"
+    assert job["attempts"] == 2
+    assert job["result"]["worker_id"].startswith("survivor-")
+    with open(completions_path) as f:
+        assert len(f.read().splitlines()) == 1
@@ -0,0 +1,214 @@
+# work_queue.py
+#
+# Durable job queue stored in a single SQLite file so analysis can be spread across several worker
+# processes (or hosts sharing the file). Jobs are claimed with a time-limited lease: a worker must
+# heartbeat before the lease expires, otherwise the job becomes visible again and another worker
+# reclaims it. Jobs that keep failing are moved to the 'dead' state instead of retrying forever.
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass
+
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "work_queue.sqlite3")
+# WAL gives concurrent readers on a local disk; network filesystems need DELETE (rollback journal) instead
+WORK_QUEUE_JOURNAL_MODE = os.getenv("WORK_QUEUE_JOURNAL_MODE", "WAL")
+# Attempts a job gets before it is dead-lettered; fixed per job when it is enqueued (by app.py)
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", 3))
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    lease_owner TEXT,
+    lease_token TEXT,
+    lease_expires_at REAL,
+    available_at REAL NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (status, available_at, lease_expires_at);
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    payload: dict
+    attempts: int
+    max_attempts: int
+    lease_token: str
+    lease_expires_at: float
+
+
+class WorkQueue:
+    def __init__(self, path: str = WORK_QUEUE_PATH, max_attempts: int = WORK_QUEUE_MAX_ATTEMPTS, retry_backoff: float = 5.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff # Seconds before a failed job is retried, multiplied by its attempt count
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per operation keeps the queue safe to use from any thread or process.
+        # isolation_level=None lets us issue BEGIN IMMEDIATE ourselves so claims take the write lock up front.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={WORK_QUEUE_JOURNAL_MODE}")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    def enqueue(self, payload: dict, max_attempts=None) -> int:
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO jobs (payload, status, max_attempts, available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (json.dumps(payload), PENDING, max_attempts or self.max_attempts, now, now, now),
+            )
+            return int(cursor.lastrowid) # type: ignore [reportArgumentType]
+        finally:
+            conn.close()
+
+    def claim(self, worker_id: str, visibility_timeout: float = 60.0):
+        # Returns the next claimable Job or None. A job is claimable when it is pending and past its
+        # retry delay, or when its lease has expired because the worker holding it stopped heartbeating.
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (PENDING, now, LEASED, now),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+
+                if row["status"] == LEASED and row["attempts"] >= row["max_attempts"]:
+                    # The last allowed attempt crashed or timed out; don't hand it out again
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, lease_token = NULL, updated_at = ? WHERE id = ?",
+                        (DEAD, f"Lease expired on final attempt (owner {row['lease_owner']})", now, row["id"]),
+                    )
+                    conn.execute("COMMIT")
+                    print(f"Job {row['id']} moved to dead-letter state after {row['attempts']} attempts.")
+                    continue
+
+                lease_token = uuid.uuid4().hex
+                lease_expires_at = now + visibility_timeout
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_token = ?, "
+                    "lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                    (LEASED, worker_id, lease_token, lease_expires_at, now, row["id"]),
+                )
+                conn.execute("COMMIT")
+                if row["status"] == LEASED:
+                    print(f"Reclaimed job {row['id']} from expired lease held by {row['lease_owner']}.")
+                return Job(
+                    id=row["id"],
+                    payload=json.loads(row["payload"]),
+                    attempts=row["attempts"] + 1,
+                    max_attempts=row["max_attempts"],
+                    lease_token=lease_token,
+                    lease_expires_at=lease_expires_at,
+                )
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _update_leased(self, job: Job, sql: str, params: tuple) -> bool:
+        # Every write-back is conditional on still holding the lease, so a worker whose lease expired
+        # (and whose job was reclaimed) can never overwrite the new owner's result.
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql + " WHERE id = ? AND lease_token = ? AND status = ?", params + (job.id, job.lease_token, LEASED))
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def heartbeat(self, job: Job, visibility_timeout: float = 60.0) -> bool:
+        now = time.time()
+        extended = self._update_leased(job, "UPDATE jobs SET lease_expires_at = ?, updated_at = ?", (now + visibility_timeout, now))
+        if extended:
+            job.lease_expires_at = now + visibility_timeout
+        return extended
+
+    def complete(self, job: Job, result: dict) -> bool:
+        return self._update_leased(
+            job,
+            "UPDATE jobs SET status = ?, result = ?, error = NULL, lease_token = NULL, updated_at = ?",
+            (DONE, json.dumps(result), time.time()),
+        )
+
+    def fail(self, job: Job, error: str) -> bool:
+        now = time.time()
+        if job.attempts >= job.max_attempts:
+            return self._update_leased(
+                job,
+                "UPDATE jobs SET status = ?, error = ?, lease_token = NULL, updated_at = ?",
+                (DEAD, error, now),
+            )
+        return self._update_leased(
+            job,
+            "UPDATE jobs SET status = ?, error = ?, lease_token = NULL, available_at = ?, updated_at = ?",
+            (PENDING, error, now + self.retry_backoff * job.attempts, now),
+        )
+
+    def get(self, job_id: int):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "max_attempts": row["max_attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def requeue_dead(self, job_id: int) -> bool:
+        # Manual recovery for dead-lettered jobs once the underlying problem is fixed
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, error = NULL, available_at = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (PENDING, time.time(), time.time(), job_id, DEAD),
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        finally:
+            conn.close()
+        counts = {status: 0 for status in (PENDING, LEASED, DONE, DEAD)}
+        counts.update({row["status"]: row["count"] for row in rows})
+        return counts
@@ -0,0 +1,110 @@
+# worker.py
+#
+# Standalone analysis worker: pulls jobs from the SQLite work queue, runs DocumentAgent.generate_report
+# and writes the report path back. Start as many as you have cores (on one host or several hosts sharing
+# the queue file); a worker that crashes simply stops heartbeating and its job is reclaimed by another.
+#
+# Usage:
+#   python worker.py --queue /shared/work_queue.sqlite3 --output-dir analysis_reports
+
+import argparse
+import os
+import socket
+import threading
+import time
+
+from work_queue import WorkQueue, WORK_QUEUE_PATH
+from memory_guard import memory_guard
+
+
+class LeaseHeartbeat:
+    # Extends the lease of the job being processed from a background thread so long generations
+    # aren't mistaken for a crashed worker.
+    def __init__(self, queue: WorkQueue, job, visibility_timeout: float, interval: float):
+        self.queue = queue
+        self.job = job
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.job, self.visibility_timeout):
+                print(f"Lost lease on job {self.job.id}; its result will be discarded.")
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue: WorkQueue, agent, worker_id: str, output_dir: str, visibility_timeout: float,
+               heartbeat_interval: float, poll_interval: float, max_jobs=None):
+    processed = 0
+    print(f"Worker {worker_id} polling {queue.path}")
+    while max_jobs is None or processed < max_jobs:
+        job = queue.claim(worker_id, visibility_timeout)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        print(f"Worker {worker_id} processing job {job.id} (attempt {job.attempts}/{job.max_attempts})")
+        with LeaseHeartbeat(queue, job, visibility_timeout, heartbeat_interval):
+            try:
+                report_path = agent.generate_report(job.payload["text"], output_dir=job.payload.get("output_dir", output_dir))
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                queue.fail(job, str(e))
+            else:
+                if queue.complete(job, {"report_path": report_path, "worker_id": worker_id}):
+                    print(f"Job {job.id} completed: {report_path}")
+        processed += 1
+
+        # Recycle only between jobs, when nothing is in flight and no lease is held
+        if memory_guard.should_recycle():
+            return "recycle"
+    return "done"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process document analysis jobs from the SQLite work queue.")
+    parser.add_argument("--queue", default=WORK_QUEUE_PATH, help="Path to the SQLite queue file")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}")
+    parser.add_argument("--output-dir", default="analysis_reports")
+    parser.add_argument("--visibility-timeout", type=float, default=float(os.getenv("WORK_QUEUE_VISIBILITY_TIMEOUT", 60)),
+                        help="Seconds a claimed job stays invisible without a heartbeat")
+    parser.add_argument("--heartbeat-interval", type=float, default=None,
+                        help="Seconds between lease extensions (default: a third of the visibility timeout)")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--max-jobs", type=int, default=None, help="Exit after processing this many jobs")
+    args = parser.parse_args(argv)
+
+    # Imported here so `--help` works without loading the models
+    from document_agent import DocumentAgent
+
+    queue = WorkQueue(args.queue)
+    agent = DocumentAgent()
+    outcome = run_worker(
+        queue,
+        agent,
+        worker_id=args.worker_id,
+        output_dir=args.output_dir,
+        visibility_timeout=args.visibility_timeout,
+        heartbeat_interval=args.heartbeat_interval or args.visibility_timeout / 3,
+        poll_interval=args.poll_interval,
+        max_jobs=args.max_jobs,
+    )
+    if outcome == "recycle":
+        memory_guard.on_recycle(agent.save_near_duplicate_index)
+        memory_guard.recycle()
+
+
+if __name__ == "__main__":
+    main()